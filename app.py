@@ -1,22 +1,29 @@
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse, StreamingResponse, Response
 import uvicorn
+import asyncio
+import hashlib
 import json
 import yaml
 import os
-import re
-from configobj import ConfigObj
+import socket
+import time
 import logging
 from models import JobConfig
-from utils import Tunasync, Kubernetes, get_last_n_lines, size_tools, check_num
+from utils import Tunasync, Kubernetes, SizeScheduler, SyncScheduler, RetryEngine, ProgressTracker, FrontReconciler, \
+    LeaderElector, get_last_n_lines, log_path, tail_offset, read_log, size_tools, check_num, REQUEST_TIME, LOG_DIR, \
+    RSYNC_LINE
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = FastAPI()
+progress = ProgressTracker()
+info_cache = {}
 
 
 @app.on_event('startup')
-def init():
-    global kubernetes, tunasync, default
+async def init():
+    global kubernetes, tunasync, default, sizes, syncs, retries, front, elector
     config = yaml.safe_load(open('config.yaml', 'r', encoding='utf-8').read())
     default = {
         "storage": config['storageClass'] if 'storageClass' in config else '',
@@ -27,8 +34,14 @@ def init():
             "imagePullSecrets": config['front']['imagePullSecrets'] if 'imagePullSecrets' in config['front'] else (
                 config['imagePullSecrets'] if 'imagePullSecrets' in config else '')
         } if 'front' in config else {},
-        "imagePullSecrets": config['imagePullSecrets'] if 'imagePullSecrets' in config else ''
+        "imagePullSecrets": config['imagePullSecrets'] if 'imagePullSecrets' in config else '',
+        "refresh_concurrency": config['refreshConcurrency'] if 'refreshConcurrency' in config else 10,
+        "bulk_concurrency": config['bulkConcurrency'] if 'bulkConcurrency' in config else 5,
+        "info_ttl": config['infoCacheTTL'] if 'infoCacheTTL' in config else 3
     }
+    sync_config = config['syncScheduler'] if 'syncScheduler' in config and config['syncScheduler'] else {}
+    sync_enabled = sync_config['enabled'] if 'enabled' in sync_config else True
+    default['fallback'] = (sync_config['fallback'] if 'fallback' in sync_config else 3) if sync_enabled else 0
     token_path = '/run/secrets/kubernetes.io/serviceaccount/token'
     ca_path = '/run/secrets/kubernetes.io/serviceaccount/ca.crt'
     ns_path = '/run/secrets/kubernetes.io/serviceaccount/namespace'
@@ -47,8 +60,86 @@ def init():
             kube_config['ca'] = config['apiServer']['ca']
     if 'namespace' in config:
         kube_config['namespace'] = config['namespace']
+    if 'serverSideApply' in config:
+        kube_config['server_side'] = bool(config['serverSideApply'])
     kubernetes = Kubernetes(**kube_config)
-    tunasync = Tunasync(f"http://{config['manager']['name']}:{config['manager']['port']}")
+    kubernetes.start()
+    pool = config['manager']['pool'] if 'pool' in config['manager'] and config['manager']['pool'] else {}
+    tunasync = Tunasync(f"http://{config['manager']['name']}:{config['manager']['port']}",
+                        limit=pool['limit'] if 'limit' in pool else 100,
+                        limit_per_host=pool['limitPerHost'] if 'limitPerHost' in pool else 30,
+                        keepalive_timeout=pool['keepalive'] if 'keepalive' in pool else 30,
+                        worker_ttl=config['manager']['workerTTL'] if 'workerTTL' in config['manager'] else 5)
+    await tunasync.start()
+    size_config = config['sizeRefresh'] if 'sizeRefresh' in config and config['sizeRefresh'] else {}
+    sizes = SizeScheduler(tunasync, get_size, active=size_config['active'] if 'active' in size_config else 300,
+                          idle=size_config['idle'] if 'idle' in size_config else 3600,
+                          concurrency=default['refresh_concurrency'])
+    retry_config = config['retry'] if 'retry' in config and config['retry'] else {}
+    retries = RetryEngine(tunasync, os.path.join(LOG_DIR, '.retry.json'),
+                          base=retry_config['base'] if 'base' in retry_config else 60,
+                          cap=retry_config['cap'] if 'cap' in retry_config else 3600,
+                          threshold=retry_config['threshold'] if 'threshold' in retry_config else 3,
+                          cooldown=retry_config['cooldown'] if 'cooldown' in retry_config else 600)
+    syncs = SyncScheduler(tunasync, kubernetes.spec, job_nodes,
+                          concurrency=sync_config['concurrency'] if 'concurrency' in sync_config else 10,
+                          per_host=sync_config['perHost'] if 'perHost' in sync_config else 2,
+                          per_node=sync_config['perNode'] if 'perNode' in sync_config else 4,
+                          jitter=sync_config['jitter'] if 'jitter' in sync_config else 60,
+                          tick=sync_config['tick'] if 'tick' in sync_config else 30,
+                          gate=retries.allow) if sync_enabled else None
+    front = FrontReconciler(tunasync, apply_front,
+                            window=config['frontDebounce'] if 'frontDebounce' in config else 10)
+    election = config['leaderElection'] if 'leaderElection' in config and config['leaderElection'] else {}
+    if 'enabled' in election and not election['enabled']:
+        elector = None
+        await lead()
+    else:
+        # 多副本时仅主节点执行后台任务，接口请求任意副本均可处理
+        elector = LeaderElector(kubernetes.api_client, kubernetes.namespace,
+                                name=election['name'] if 'name' in election else 'tunasync-controller',
+                                identity=os.getenv('POD_NAME') or socket.gethostname(),
+                                duration=election['duration'] if 'duration' in election else 15,
+                                deadline=election['deadline'] if 'deadline' in election else 10,
+                                renew=election['renew'] if 'renew' in election else 2,
+                                on_start=lead, on_stop=follow)
+        elector.start()
+
+
+async def lead():
+    sizes.start()
+    await retries.start()
+    if syncs:
+        syncs.start()
+    if default['front']:
+        front.start()
+
+
+async def follow():
+    await front.stop()
+    if syncs:
+        await syncs.stop()
+    await retries.stop()
+    await sizes.stop()
+
+
+async def job_nodes() -> dict:
+    nodes = {}
+    for name, pods in (await kubernetes.pods()).items():
+        for pod in pods:
+            if pod['node']:
+                nodes[name] = pod['node']
+    return nodes
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    if elector:
+        await elector.stop()
+    else:
+        await follow()
+    await kubernetes.stop()
+    await tunasync.stop()
 
 
 def response(content, code: int = 200, format: bool = True):
@@ -63,6 +154,21 @@ def response(content, code: int = 200, format: bool = True):
         return JSONResponse(status_code=code, content=content)
 
 
+@app.middleware('http')
+async def metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    resp = await call_next(request)
+    route = request.scope.get('route')
+    REQUEST_TIME.labels(request.method, route.path if route else 'unknown', resp.status_code).observe(
+        time.perf_counter() - start)
+    return resp
+
+
+@app.get('/metrics')
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_error_handler(*args):
     return response('query param unexpected', 400)
@@ -74,7 +180,7 @@ async def exception_handler(*args):
 
 
 async def check_name(name: str) -> bool:
-    return False if name not in [i['id'] for i in await tunasync.workers()] else True
+    return name in await tunasync.worker_index()
 
 
 async def get_size(name: str) -> str:
@@ -85,29 +191,20 @@ async def get_size(name: str) -> str:
     job = job[0]
     if 'status' in job:
         if job['status'] == 'success':
-            lines = await get_last_n_lines(name, 20)
-            for line in lines:
-                if 'size' in line.lower():
-                    size_line = re.findall(r'(\d+\.?\d+?[BKMGTP])', line)
-                    if size_line and size_tools.XiB_MB(size_log) < size_tools.XiB_MB(size_line[0]):
-                        size_log = size_line[0]
+            size_log = (await progress.get(name)).total_size
         elif job['status'] == 'syncing':
-            try:
-                provider = ConfigObj((await kubernetes.config(name)).split('\n'), list_values=False)['server'][
-                    'mirrors']['provider'].replace('"', '')
-            except:
-                provider = ''
-            if 'rsync' in provider:
-                lines = await get_last_n_lines(name, 5)
-                for line in lines:
-                    if 'B/s' in line:
-                        parts = line.split()
-                        if len(parts) >= 4:
-                            size_log = size_tools.XB_XiB(parts[0])
-    pod = await kubernetes.pod(name=name, ready=True)
-    if pod:
-        size_df = size_tools.format(int(
-            (await kubernetes.exec(pod[0]['name'], ['df', f'/data/mirrors/{name}', '--output=used'])).split('\n')[1]))
+            spec = await kubernetes.spec(name)
+            if spec and 'rsync' in spec.provider:
+                size_log = (await progress.get(name)).size
+    used = (await kubernetes.volume_usage()).get(f'{name}-data')
+    if used:
+        size_df = size_tools.format(used / 1024)
+    else:
+        pod = await kubernetes.pod(name=name, ready=True)
+        if pod:
+            size_df = size_tools.format(int(
+                (await kubernetes.exec(pod[0]['name'], ['df', f'/data/mirrors/{name}', '--output=used'])).split(
+                    '\n')[1]))
     if size_log:
         logging.debug(f'Size in log is {size_log}')
     if size_df:
@@ -123,6 +220,58 @@ async def get_size(name: str) -> str:
     return size
 
 
+def job_volumes(name: str) -> (list, list):
+    volumeMounts = [
+        {'mountPath': '/var/log/tunasync', 'name': 'data'},
+        {'mountPath': f"/data/mirrors/{name}", 'name': f"{name}-data"},
+        {'mountPath': '/etc/tunasync/', 'name': name}
+    ]
+    volumes = [
+        {'name': 'data', 'persistentVolumeClaim': {'claimName': 'data'}},
+        {'name': f"{name}-data", 'persistentVolumeClaim': {'claimName': f"{name}-data"}},
+        {'name': name, 'configMap': {'name': name}}
+    ]
+    return volumeMounts, volumes
+
+
+async def provision(name: str, data: dict) -> (str, dict):
+    timing = {}
+
+    async def stage(key: str, mode: str, res_name: str, **kwargs) -> bool:
+        start = time.perf_counter()
+        success = await kubernetes.apply(mode, res_name, **kwargs)
+        timing[key] = round(time.perf_counter() - start, 3)
+        if success:
+            logging.debug(f'生成 {name} {key} 成功')
+        else:
+            logging.warning(f'生成 {name} {key} 失败')
+        return success
+
+    resources = [('config map', 'cm', name), ('persistent volume claim', 'pvc', f"{name}-data"),
+                 ('service', 'svc', name)]
+    existed = await asyncio.gather(*[kubernetes.exists(mode, res_name) for _, mode, res_name in resources])
+    results = await asyncio.gather(
+        stage('config map', 'cm', name, manager=tunasync.api, data=data, fallback=default['fallback']),
+        stage('persistent volume claim', 'pvc', f"{name}-data", storageclass=default['storage'],
+              data_size=data['data_size']),
+        stage('service', 'svc', name, port=6000)
+    )
+    failed = [key for (key, _, _), success in zip(resources, results) if not success]
+    if not failed:
+        volumeMounts, volumes = job_volumes(name)
+        if not await stage('deployment', 'deploy', name, node=data['node'], image=data['image'], port=6000,
+                           volumeMounts=volumeMounts, volumes=volumes, imagePullSecrets=default['imagePullSecrets']):
+            failed.append('deployment')
+    if failed:
+        # 仅回滚本次新建的资源，已有的储存卷等保持不动
+        await asyncio.gather(*[kubernetes.delete(mode, res_name) for (_, mode, res_name), ok in
+                               zip(resources, existed) if not ok])
+        logging.warning(f'部署 {name} 失败，已回滚')
+        return failed[0], timing
+    logging.debug(f'部署 {name} 成功')
+    return '', timing
+
+
 @app.get('/init')
 async def setup():
     if not await kubernetes.get('deploy', 'tunasync-manager'):
@@ -186,21 +335,29 @@ async def manage_info(request: Request = None):
 async def front_deploy(addition: str = None):
     if not default['front']:
         return response('front not config', 400)
+    if addition:
+        front.add(addition)
+    if await front.reconcile(force=True):
+        return response('reload front succeed')
+    else:
+        return response('reload front failed', 500)
+
+
+async def apply_front(names: list) -> bool:
+    if not default['front']:
+        return False
     volumeMounts = [
         {'mountPath': '/etc/caddy/Caddyfile', 'name': 'caddy-conf', 'subPath': 'Caddyfile', 'readOnly': True},
         {'mountPath': '/usr/share/caddy/static', 'name': 'static', 'readOnly': True},
         {'mountPath': '/usr/share/caddy/status.html', 'name': 'status-html', 'subPath': 'status.html', 'readOnly': True}
     ]
-    workers = await tunasync.workers()
-    if addition:
-        workers.append({"id": addition})
-    for i in workers:
-        if i["id"] == "pypi":
+    for i in names:
+        if i == "pypi":
             volumeMounts.append(
                 {'mountPath': '/usr/share/caddy/pypi', 'name': 'pypi', 'subPath': 'web', 'readOnly': True})
         else:
-            volumeMounts.append({'mountPath': f'/usr/share/caddy/{i["id"]}', 'name': i["id"], 'readOnly': True})
-    volumes = [{'name': i["id"], 'persistentVolumeClaim': {'claimName': f'{i["id"]}-data'}} for i in workers]
+            volumeMounts.append({'mountPath': f'/usr/share/caddy/{i}', 'name': i, 'readOnly': True})
+    volumes = [{'name': i, 'persistentVolumeClaim': {'claimName': f'{i}-data'}} for i in names]
     volumes.append({'name': 'caddy-conf', 'configMap': {'name': 'caddy-conf'}})
     volumes.append({'name': 'static', 'configMap': {'name': 'mirrors-static'}})
     volumes.append({'name': 'status-html', 'configMap': {'name': 'status-html'}})
@@ -208,10 +365,10 @@ async def front_deploy(addition: str = None):
                               image=default['front']['image'], port=6000, volumeMounts=volumeMounts, volumes=volumes,
                               imagePullSecrets=default['front']['imagePullSecrets']):
         logging.debug('更新前端成功')
-        return response('reload front succeed')
+        return True
     else:
         logging.warning('前端更新失败')
-        return response('reload front failed', 500)
+        return False
 
 
 @app.delete('/manager')
@@ -234,75 +391,106 @@ async def pod_restart(name: str = '', request: Request = None):
         return response('restart failed', 500)
 
 
-@app.post('/job')
-async def job_creator(req: JobConfig):
+def prepare_job(req: JobConfig, nodes: list) -> (str, dict):
     if not req.name or not req.upstream:
-        return response('not include name or upstream', 400)
-    name = req.name
-    if await check_name(name):
-        return response('job already exists', 400)
-    if req.image:
-        image = req.image
-    else:
-        image = 'ztelliot/tunasync_worker:rsync'
-    if req.data_size:
-        data_size = req.data_size
-    else:
-        data_size = '1Ti'
-    if req.node:
-        node = req.node
-    else:
-        node = default['node']
-    if node and node not in await kubernetes.nodes():
-        return response('selected node not exists', 400)
+        return 'not include name or upstream', {}
     data = req.dict()
+    data['image'] = req.image if req.image else 'ztelliot/tunasync_worker:rsync'
+    data['data_size'] = req.data_size if req.data_size else '1Ti'
+    data['node'] = req.node if req.node else default['node']
+    if data['node'] and data['node'] not in nodes:
+        return 'selected node not exists', {}
     if not data['provider']:
         data['provider'] = 'rsync'
     if data['provider'] not in ['rsync', 'command', 'two-stage-rsync']:
-        return response('unsupported provider', 400)
-    if not data['concurrent'] or check_num(data['concurrent']):
+        return 'unsupported provider', {}
+    if not check_num(data['concurrent']):
         data['concurrent'] = 3
-    if not data['interval'] or check_num(data['interval']):
+    if not check_num(data['interval']):
         data['interval'] = 1440
     if data['provider'] == 'command' and ('command' not in data or not data['command']):
-        return response('command provider should specify the command', 400)
-    if await kubernetes.apply('cm', name, manager=tunasync.api, data=data):
-        logging.debug(f'生成 {name} 配置文件成功')
-    else:
-        logging.warning(f'生成 {name} 配置文件失败')
-        return response('something error when apply config map', 500)
-    if await kubernetes.apply('pvc', f"{name}-data", storageclass=default['storage'], data_size=data_size):
-        logging.debug(f'生成 {name} 储存卷成功')
-    else:
-        logging.warning(f'生成 {name} 储存卷失败')
-        return response('something error when apply persistent volume claim', 500)
-    if await kubernetes.apply('svc', name, port=6000):
-        logging.debug(f'生成 {name} 服务成功')
-    else:
-        logging.warning(f'生成 {name} 服务失败')
-        return response('something error when apply service', 500)
-    volumeMounts = [
-        {'mountPath': '/var/log/tunasync', 'name': 'data'},
-        {'mountPath': f"/data/mirrors/{name}", 'name': f"{name}-data"},
-        {'mountPath': '/etc/tunasync/', 'name': name}
-    ]
-    volumes = [
-        {'name': 'data', 'persistentVolumeClaim': {'claimName': 'data'}},
-        {'name': f"{name}-data", 'persistentVolumeClaim': {'claimName': f"{name}-data"}},
-        {'name': name, 'configMap': {'name': name}}
-    ]
-    if await kubernetes.apply('deploy', name, node=node, image=image, port=6000, volumeMounts=volumeMounts,
-                              volumes=volumes, imagePullSecrets=default['imagePullSecrets']):
-        logging.debug(f'部署 {name} 成功')
-        front_res = await front_deploy(name)
-        if front_res.status_code != 200:
-            logging.warning('更新前端服务失败')
-            return response(f'create {name} succeed, but reload front failed')
-        logging.debug('更新前端服务成功')
+        return 'command provider should specify the command', {}
+    return '', data
+
+
+@app.post('/job')
+async def job_creator(req: JobConfig):
+    if req.name and await check_name(req.name):
+        return response('job already exists', 400)
+    error, data = prepare_job(req, await kubernetes.nodes() if req.node or default['node'] else [])
+    if error:
+        return response(error, 400)
+    name = data['name']
+    failed, timing = await provision(name, data)
+    if failed:
+        return JSONResponse(status_code=500,
+                            content={'error': f'something error when apply {failed}', 'timing': timing})
+    tunasync.invalidate_workers()
+    if default['front']:
+        front.add(name)
+    return response({'msg': f'create {name} succeed', 'timing': timing})
+
+
+def bulk_result(res) -> dict:
+    body = json.loads(res.body)
+    return {'code': res.status_code, 'msg': body['error'] if 'error' in body else body['msg']}
+
+
+async def bulk_run(func, items: list) -> list:
+    semaphore = asyncio.Semaphore(default['bulk_concurrency'])
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return bulk_result(await func(item))
+            except Exception as e:
+                logging.warning(e)
+                return {'code': 500, 'msg': 'something error'}
+
+    return await asyncio.gather(*[run(i) for i in items])
+
+
+@app.post('/jobs')
+async def job_bulk_creator(reqs: list[JobConfig]):
+    nodes, workers = await asyncio.gather(kubernetes.nodes(), tunasync.worker_index())
+    data = {}
+    jobs = {}
+    for req in reqs:
+        error, job = prepare_job(req, nodes)
+        if not error and (job['name'] in workers or job['name'] in jobs):
+            error = 'job already exists'
+        if error:
+            data[req.name if req.name else f'#{len(data)}'] = {'code': 400, 'msg': error}
+        else:
+            jobs[job['name']] = job
+
+    async def create(name: str):
+        failed, timing = await provision(name, jobs[name])
+        if failed:
+            return JSONResponse(status_code=500, content={'error': f'something error when apply {failed}'})
         return response(f'create {name} succeed')
-    else:
-        logging.warning(f'部署 {name} 失败')
-        return response('something error when apply deployment', 500)
+
+    data.update(zip(jobs, await bulk_run(create, list(jobs))))
+    created = [i for i in jobs if data[i]['code'] == 200]
+    if created:
+        tunasync.invalidate_workers()
+        if default['front']:
+            for i in created:
+                front.add(i)
+    return response({'msg': 'success', 'data': data})
+
+
+@app.patch('/jobs')
+async def job_bulk_modify(reqs: list[JobConfig]):
+    reqs = [i for i in reqs if i.name]
+    results = await bulk_run(lambda req: job_modify(req.name, req), reqs)
+    return response({'msg': 'success', 'data': {req.name: res for req, res in zip(reqs, results)}})
+
+
+@app.delete('/jobs')
+async def job_bulk_delete(names: list[str]):
+    results = await bulk_run(job_delete, names)
+    return response({'msg': 'success', 'data': dict(zip(names, results))})
 
 
 @app.get('/job')
@@ -318,123 +506,130 @@ async def job_list(status: str = 'all', filter: str = ''):
         else:
             jobs[i['name']] = i
     data = json.loads(json.dumps(jobs, sort_keys=True))
+    pods, top = await asyncio.gather(kubernetes.pods(), kubernetes.top())
+    if not isinstance(top, dict):
+        top = {}
     for i in data:
+        if sizes.get(i):
+            data[i]['size'] = sizes.get(i)
         data[i]['pods'] = []
-        pods = await kubernetes.pod(name=i)
-        for pod in pods:
-            top = await kubernetes.top(pod['name'])
-            if top and 'usage' in top:
-                pod['usage'] = top['usage']
+        for pod in pods.get(i, []):
+            if pod['name'] in top and 'usage' in top[pod['name']]:
+                pod['usage'] = top[pod['name']]['usage']
             data[i]['pods'].append(pod)
     return response({'msg': 'success', 'data': list(data.values())})
 
 
-@app.get('/job/{name}')
-async def job_info(name: str, status: bool = True):
-    if not await check_name(name):
-        return response('job not exists', 404)
+async def job_detail(name: str, status: bool = True) -> dict:
     data = {"status": {}, "spec": {}}
-    config = (await kubernetes.config(name)).split('\n')
-    if config:
-        obj = ConfigObj(config, list_values=False)
-        data['spec'] = {
-            'concurrent': obj['global']['concurrent'],
-            'interval': obj['global']['interval'],
-            'provider': obj['server']['mirrors']['provider'].replace('"', ''),
-            'upstream': obj['server']['mirrors']['upstream'].replace('"', '')
-        }
-        if 'command' in obj['server']['mirrors']:
-            data['spec']['command'] = obj['server']['mirrors']['command'].replace('"', '')
-        if 'rsync_options' in obj['server']['mirrors']:
-            rsync_options = obj['server']['mirrors']['rsync_options'][1:-1].replace('"', '').replace(' ', '').split(',')
-            if '--info=progress2' in rsync_options:
-                rsync_options.remove('--info=progress2')
-            if rsync_options:
-                data['spec']['rsync_options'] = rsync_options
-        if 'memory_limit' in obj['server']['mirrors']:
-            data['spec']['memory_limit'] = obj['server']['mirrors']['memory_limit'].replace('"', '')
-        if 'size_pattern' in obj['server']['mirrors']:
-            data['spec']['size_pattern'] = obj['server']['mirrors']['size_pattern'].replace('"', '')
-        if 'mirrors.env' in obj:
-            data['spec']['addition_option'] = {i: obj['mirrors.env'][i].replace('"', '') for i in obj['mirrors.env']}
-        data['spec']['data_size'] = await kubernetes.pvc_size(f'{name}-data')
-        node, image = await kubernetes.deploy_node_image(name)
+    tasks = [kubernetes.spec(name), kubernetes.pvc_size(f'{name}-data'), kubernetes.deploy_node_image(name)]
+    if status:
+        tasks += [tunasync.jobs(worker=name), kubernetes.pod(name=name), kubernetes.top()]
+    spec, data_size, (node, image), *rest = await asyncio.gather(*tasks)
+    if spec:
+        data['spec'] = spec.to_dict()
+        data['spec']['data_size'] = data_size
         if node:
             data['spec']['node'] = node
         data['spec']['image'] = image
-        del obj
     if status:
-        job = await tunasync.jobs(worker=name)
+        job, pods, top = rest
         if job:
             data['status'] = job[0]
         else:
             data['status'] = {'name': name, 'status': 'disabled'}
+        if sizes.get(name):
+            data['status']['size'] = sizes.get(name)
+        if not isinstance(top, dict):
+            top = {}
         data['status']['pods'] = []
-        pods = await kubernetes.pod(name=name)
         for pod in pods:
-            top = await kubernetes.top(pod['name'])
-            if top and 'usage' in top:
-                pod['usage'] = top['usage']
+            if pod['name'] in top and 'usage' in top[pod['name']]:
+                pod['usage'] = top[pod['name']]['usage']
             data['status']['pods'].append(pod)
-        data['status']['data_size'] = await kubernetes.pvc_size(f'{name}-data')
-        if 'status' in job and job['status'] == 'syncing' and 'rsync' in data['spec']['provider']:
-            rstatus = {'rsync_size': '', 'file_name': '', 'remain': '', 'speed': '', 'rate': ''}
-            lines = await get_last_n_lines(name, 5)
-            for line in lines:
-                if 'B/s' in line:
-                    if 'xfr' in line:
-                        chk = str(re.findall(r'[(](.*?)[)]', line)[0])
-                        rstatus['chk_now'] = re.findall(r'[#](.*?)[,]', chk)[0]
-                        rstatus['chk_remain'] = re.findall(r'[=](.*?)[/]', chk)[0]
-                        rstatus['total'] = chk.split("/")[1]
-                    parts = line.split()
-                    if len(parts) >= 4:
-                        rstatus['rsync_size'] = size_tools.XB_XiB(parts[0])
-                        rstatus['rate'] = parts[1]
-                        rstatus['speed'] = parts[2]
-                        rstatus['remain'] = parts[3]
-                elif line and line != '\n':
-                    files = line.split('/')
-                    rstatus['file_name'] = files[-1].replace('\n', '')
-            try:
-                rstatus['chk_now'] = int(rstatus['chk_now'])
-                rstatus['chk_remain'] = int(rstatus['chk_remain'])
-                rstatus['total'] = int(rstatus['total'])
-            except:
-                rstatus['chk_now'] = rstatus['chk_remain'] = rstatus['total'] = 0
-            data['status'].update(rstatus)
-    return response({'msg': 'success', 'data': data})
+        data['status']['data_size'] = data_size
+        if data['status'].get('status') == 'syncing' and 'rsync' in data['spec'].get('provider', ''):
+            data['status'].update((await progress.get(name)).status())
+    return data
+
+
+@app.get('/job/{name}')
+async def job_info(name: str, status: bool = True, request: Request = None):
+    if not await check_name(name):
+        return response('job not exists', 404)
+    key = (name, status)
+    if key in info_cache and info_cache[key][0] > time.monotonic():
+        _, etag, content = info_cache[key]
+    else:
+        content = json.dumps({'msg': 'success', 'data': await job_detail(name, status)}, sort_keys=True, indent=4,
+                             allow_nan=False)
+        etag = f'"{hashlib.sha1(content.encode()).hexdigest()[:16]}"'
+        info_cache[key] = (time.monotonic() + default['info_ttl'], etag, content)
+    headers = {'ETag': etag, 'Cache-Control': f"max-age={default['info_ttl']}"}
+    if request and request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return PlainTextResponse(status_code=200, media_type='application/json', content=content, headers=headers)
+
+
+def drop_info_cache(name: str):
+    for i in [i for i in info_cache if i[0] == name]:
+        del info_cache[i]
 
 
 @app.get('/job/{name}/log')
-async def job_log(name: str, line: int = 0):
+async def job_log(name: str, line: int = 0, offset: int = -1, stream: bool = False, follow: bool = False,
+                  request: Request = None):
     if not await check_name(name):
         return PlainTextResponse(status_code=404, content='Job Not Found')
-    if line:
-        if isinstance(line, int):
-            content = ''
-            for l in await get_last_n_lines(name, line):
-                content += l + '\n'
-            return PlainTextResponse(content=content)
+    if line < 0:
+        return PlainTextResponse(status_code=400, content='line not int')
+    path = log_path(name)
+    if not os.path.exists(path):
+        return PlainTextResponse(status_code=404, content='Log Not Found')
+    sse = 'text/event-stream' in request.headers.get('accept', '')
+    if sse and check_num(request.headers.get('last-event-id')):
+        offset = int(request.headers['last-event-id'])
+    if not stream and not follow and not sse and offset < 0:
+        if line:
+            return PlainTextResponse(content='\n'.join(await get_last_n_lines(name, line)) + '\n')
         else:
-            return PlainTextResponse(status_code=400, content='line not int')
-    else:
-        return FileResponse(f'/var/lib/tunasync/{name}/latest')
+            return FileResponse(path)
+    if offset < 0:
+        if line or follow:
+            offset = await asyncio.to_thread(tail_offset, path, line or 10)
+        else:
+            offset = 0
+
+    async def content():
+        async for pos, chunk in read_log(path, offset, follow=follow):
+            if sse:
+                # rsync 进度以 \r 分隔，SSE 同样将其视为换行，需逐行加上 data 字段
+                lines = RSYNC_LINE.split(chunk)
+                if not lines[-1]:
+                    lines.pop()
+                yield f'id: {pos}\n' + ''.join(f"data: {i.decode(errors='replace')}\n" for i in lines) + '\n'
+            else:
+                yield chunk
+
+    return StreamingResponse(content(), media_type='text/event-stream' if sse else 'text/plain',
+                             headers={'X-Log-Offset': str(offset), 'Cache-Control': 'no-cache'})
 
 
 @app.patch('/job/{name}')
 async def job_modify(name: str, req: JobConfig):
-    data = req.dict()
-    conf = await job_info(name, status=False)
-    if conf.status_code != 200:
+    if not await check_name(name):
         return response('job not exists', 404)
-    ori = json.loads(conf.body)['data']['spec']
+    data = req.dict()
+    ori = (await job_detail(name, status=False))['spec']
     for i in ori:
         if i not in data or not data[i]:
             data[i] = ori[i]
+    if isinstance(data['rsync_options'], str):
+        data['rsync_options'] = data['rsync_options'].split()
     diff = False
     for i in data:
-        if i in ['data_size', 'image', 'node'] or (i in ori and data[i] == ori[i]) or (i not in ori and not data[i]):
+        if i in ['name', 'data_size', 'image', 'node'] or (i in ori and data[i] == ori[i]) or \
+                (i not in ori and not data[i]):
             pass
         else:
             diff = True
@@ -445,11 +640,11 @@ async def job_modify(name: str, req: JobConfig):
                 return response('unsupported provider', 400)
             if data['provider'] == 'command' and ('command' not in data or not data['command']):
                 return response('command provider should specify the command', 400)
-        if check_num(data['concurrent']):
+        if not check_num(data['concurrent']):
             data['concurrent'] = 3
-        if check_num(data['interval']):
+        if not check_num(data['interval']):
             data['interval'] = 1440
-        if await kubernetes.apply('cm', name, manager=tunasync.api, data=data):
+        if await kubernetes.apply('cm', name, manager=tunasync.api, data=data, fallback=default['fallback']):
             if await tunasync.cmd(name, 'reload') and await tunasync.cmd(name, 'restart') and \
                     await tunasync.cmd(name, 'start'):
                 logging.debug(f'修改 {name} 配置文件成功')
@@ -471,19 +666,14 @@ async def job_modify(name: str, req: JobConfig):
             node = data['node']
         else:
             node = ''
-        if await kubernetes.apply('deploy', name, node=node, image=data['image'], port=6000, volumeMounts=[
-            {'mountPath': '/var/log/tunasync', 'name': 'data'},
-            {'mountPath': f"/data/mirrors/{name}", 'name': f"{name}-data"},
-            {'mountPath': '/etc/tunasync/', 'name': name}
-        ], volumes=[
-            {'name': 'data', 'persistentVolumeClaim': {'claimName': 'data'}},
-            {'name': f"{name}-data", 'persistentVolumeClaim': {'claimName': f"{name}-data"}},
-            {'name': name, 'configMap': {'name': name}}
-        ]):
+        volumeMounts, volumes = job_volumes(name)
+        if await kubernetes.apply('deploy', name, node=node, image=data['image'], port=6000, volumeMounts=volumeMounts,
+                                  volumes=volumes, imagePullSecrets=default['imagePullSecrets']):
             logging.debug(f'部署 {name} 成功')
         else:
             logging.warning(f'部署 {name} 失败')
             return response('something error when apply deployment', 500)
+    drop_info_cache(name)
     return response('success')
 
 
@@ -491,6 +681,7 @@ async def job_modify(name: str, req: JobConfig):
 async def job_manage(name: str, cmd: str):
     if not await check_name(name):
         return response('job not exists', 404)
+    drop_info_cache(name)
     if cmd in ['start', 'stop', 'restart']:
         if not await tunasync.cmd(name, cmd):
             return response('failed', 500)
@@ -501,7 +692,7 @@ async def job_manage(name: str, cmd: str):
         if not await tunasync.cmd(name, 'reload'):
             return response('failed', 500)
     elif cmd == 'refresh':
-        if not await tunasync.set_size(name, name, await get_size(name)):
+        if not await sizes.refresh(name, force=True):
             return response('failed', 500)
     else:
         return response('command not exists', 404)
@@ -512,6 +703,7 @@ async def job_manage(name: str, cmd: str):
 async def job_delete(name: str):
     if not await check_name(name):
         return response('job not exists', 404)
+    drop_info_cache(name)
     failed = []
     if not await tunasync.cmd(name, 'disable'):
         failed.append('disable')
@@ -523,6 +715,10 @@ async def job_delete(name: str):
         failed.append('config map')
     if not await tunasync.delete_worker(name):
         failed.append('worker')
+    tunasync.invalidate_workers()
+    progress.remove(name)
+    if default['front']:
+        front.remove(name)
     if not await tunasync.flush_disabled():
         failed.append('flush')
     if not failed:
@@ -533,26 +729,39 @@ async def job_delete(name: str):
 
 @app.post('/job/refresh')
 async def job_refresh(update: bool = False, retry: bool = False):
-    failed = False
-    jobs = await tunasync.jobs()
-    for job in jobs:
+    semaphore = asyncio.Semaphore(default['refresh_concurrency'])
+
+    async def refresh(job: dict) -> dict:
         name = job['name']
-        if update:
-            size = await get_size(name)
-            if await tunasync.set_size(name, name, size):
-                logging.debug(f'{name} 当前大小为 {size}，更新数据库成功')
-            else:
-                failed = True
-                logging.warning(f'{name} 当前大小为 {size}，更新数据库失败')
-        if retry and job['status'] == 'failed':
-            if await tunasync.cmd(name, 'start'):
-                logging.debug(f'{name} 同步失败，重新开始')
-            else:
-                failed = True
-                logging.warning(f'{name} 同步失败，重开失败')
-    if failed:
-        return response('something failed', 500)
-    return response('success')
+        result = {}
+        async with semaphore:
+            try:
+                if update:
+                    result['update'] = 'success' if await sizes.refresh(name, force=True) else 'failed'
+                    result['size'] = sizes.get(name)
+                if retry and job['status'] == 'failed':
+                    # 手动重试同样遵循熔断，失败计数与退避由后台重试任务维护
+                    if not retries.allow(SyncScheduler.host(job.get('upstream', ''))):
+                        result['retry'] = 'skipped'
+                    elif await tunasync.cmd(name, 'start'):
+                        result['retry'] = 'success'
+                        logging.debug(f'{name} 同步失败，重新开始')
+                    else:
+                        result['retry'] = 'failed'
+                        logging.warning(f'{name} 同步失败，重开失败')
+            except Exception as e:
+                result['error'] = repr(e)
+                logging.warning(f'{name} 刷新失败: {e!r}')
+        return result
+
+    if retry:
+        await retries.sync()
+    jobs = await tunasync.jobs()
+    results = await asyncio.gather(*[refresh(job) for job in jobs])
+    data = {job['name']: res for job, res in zip(jobs, results)}
+    if any('error' in i or 'failed' in i.values() for i in data.values()):
+        return JSONResponse(status_code=500, content={'error': 'something failed', 'data': data})
+    return response({'msg': 'success', 'data': data})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""GET /job 延迟基准：逐任务查询 (N+1) 与批量查询对比
+
+启动一个模拟 Kubernetes API / metrics.k8s.io / tunasync-manager 的本地 HTTP 服务，
+每个请求附加固定延迟模拟网络往返，随任务数增长分别测量两种实现的耗时与请求数。
+
+    python benchmarks/job_list.py [--latency 0.002] [--jobs 10 40 80 160] [--rounds 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+from utils import Kubernetes, SizeScheduler, Tunasync  # noqa: E402
+
+NAMESPACE = 'mirrors'
+
+
+def pod(name: str) -> dict:
+    return {
+        'metadata': {'name': f'{name}-0', 'namespace': NAMESPACE, 'labels': {'app': name}},
+        'spec': {'nodeName': 'node-1', 'containers': [{'name': name, 'image': 'worker:latest'}]},
+        'status': {'phase': 'Running', 'containerStatuses': [
+            {'name': name, 'image': 'worker:latest', 'imageID': '', 'ready': True, 'restartCount': 0}]}
+    }
+
+
+def usage(name: str) -> dict:
+    return {'metadata': {'name': f'{name}-0', 'namespace': NAMESPACE},
+            'containers': [{'name': name, 'usage': {'cpu': '1m', 'memory': '10Mi'}}]}
+
+
+def stub(jobs: list, latency: float, counter: list) -> web.Application:
+    async def delay(request, handler):
+        counter[0] += 1
+        await asyncio.sleep(latency)
+        return await handler(request)
+
+    async def pods(request):
+        selector = request.query.get('labelSelector', '')
+        names = [selector[4:]] if selector.startswith('app=') else jobs
+        return web.json_response({'kind': 'PodList', 'apiVersion': 'v1', 'metadata': {},
+                                  'items': [pod(i) for i in names if i in jobs]})
+
+    async def metrics(request):
+        return web.json_response({'kind': 'PodMetricsList', 'items': [usage(i) for i in jobs]})
+
+    async def metric(request):
+        return web.json_response(usage(request.match_info['name'][:-2]))
+
+    async def manager_jobs(request):
+        return web.json_response([{'name': i, 'status': 'success', 'size': '1G'} for i in jobs])
+
+    async def workers(request):
+        return web.json_response([{'id': i} for i in jobs])
+
+    application = web.Application(middlewares=[web.middleware(delay)])
+    application.router.add_get(f'/api/v1/namespaces/{NAMESPACE}/pods', pods)
+    application.router.add_get(f'/apis/metrics.k8s.io/v1beta1/namespaces/{NAMESPACE}/pods', metrics)
+    application.router.add_get(f'/apis/metrics.k8s.io/v1beta1/namespaces/{NAMESPACE}/pods/{{name}}', metric)
+    application.router.add_get('/jobs', manager_jobs)
+    application.router.add_get('/workers', workers)
+    return application
+
+
+async def n_plus_one():
+    # aec69b9 之前的 job_list：每个任务查询一次 Pod，每个 Pod 再查询一次 metrics
+    data = {i['id']: {'name': i['id'], 'status': 'disabled'} for i in await app.tunasync.workers()}
+    for i in await app.tunasync.jobs():
+        data[i['name']] = i
+    for i in data:
+        data[i]['pods'] = []
+        for p in await app.kubernetes.pod(name=i):
+            top = await app.kubernetes.top(p['name'])
+            if top and 'usage' in top:
+                p['usage'] = top['usage']
+            data[i]['pods'].append(p)
+    return data
+
+
+async def batched():
+    return await app.job_list()
+
+
+async def measure(func, rounds: int, counter: list) -> (float, float):
+    await func()
+    counter[0] = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await func()
+    return (time.perf_counter() - start) / rounds * 1000, counter[0] / rounds
+
+
+async def main(args):
+    print(f'latency per request: {args.latency * 1000:.1f} ms')
+    print(f'{"jobs":>6} {"N+1 ms":>10} {"N+1 reqs":>9} {"batched ms":>11} {"batched reqs":>13}')
+    for n in args.jobs:
+        jobs = [f'job{i}' for i in range(n)]
+        counter = [0]
+        runner = web.AppRunner(stub(jobs, args.latency, counter))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+        app.kubernetes = Kubernetes(url, token='bench', namespace=NAMESPACE)
+        app.tunasync = Tunasync(url)
+        await app.tunasync.start()
+        app.sizes = SizeScheduler(app.tunasync, None)
+        try:
+            old, old_reqs = await measure(n_plus_one, args.rounds, counter)
+            new, new_reqs = await measure(batched, args.rounds, counter)
+            print(f'{n:>6} {old:>10.1f} {old_reqs:>9.0f} {new:>11.1f} {new_reqs:>13.0f}')
+        finally:
+            await app.tunasync.stop()
+            await app.kubernetes.api_client.close()
+            await app.kubernetes.command['pod']['exec'].__self__.api_client.close()
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds added to every stub request')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[10, 40, 80, 160])
+    parser.add_argument('--rounds', type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
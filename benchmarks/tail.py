@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""日志尾部读取：tail_offset / tail 与 `tail -n` 的一致性校验及性能对比
+
+先用随机内容与随机块大小逐字节比对 utils.tail 与 `tail -n` 的输出，
+再在生成的大日志上对比进程内读取 (get_last_n_lines) 与原先 shell 调用 tail 的耗时。
+
+    python benchmarks/tail.py [--size 2048] [--lines 20] [--rounds 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils  # noqa: E402
+
+
+def check(trials: int = 300):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'latest')
+        for _ in range(trials):
+            lines = ['x' * random.randint(0, 30) for _ in range(random.randint(0, 50))]
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + random.choice(['', '\n', '\n\n']))
+            for n in [0, 1, 2, 3, 7, 60]:
+                expect = subprocess.run(['tail', '-n', str(n), path], capture_output=True, check=True).stdout
+                got = utils.tail(path, n, block=random.randint(1, 16))
+                assert got == expect, (n, expect, got)
+    print(f'tail: {trials} random files match `tail -n`')
+
+
+async def shell_tail(path: str, n: int) -> list:
+    # 5924b2e 之前的实现
+    proc = await asyncio.create_subprocess_shell(f'tail -n {n} {path}', stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return stdout.decode().split('\n') if stdout else []
+
+
+async def bench(size: int, n: int, rounds: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(os.path.join(tmp, 'job'))
+        path = os.path.join(tmp, 'job', 'latest')
+        line = b'  1,234,567  42%   12.34MB/s    0:01:23 (xfr#1234, to-chk=5678/91011)\n'
+        block = line * (1024 * 1024 // len(line))
+        with open(path, 'wb') as f:
+            for _ in range(size):
+                f.write(block)
+        utils.LOG_DIR = tmp
+        assert await utils.get_last_n_lines('job', n) == await shell_tail(path, n)
+        print(f'log: {os.path.getsize(path) / 1024 ** 3:.2f} GiB, last {n} lines, {rounds} rounds')
+        for name, func in [('in-process', lambda: utils.get_last_n_lines('job', n)),
+                           ('subprocess', lambda: shell_tail(path, n))]:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await func()
+            print(f'{name:>12}: {(time.perf_counter() - start) / rounds * 1000:.3f} ms per call')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2048, help='log size in MiB')
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+    check()
+    asyncio.run(bench(args.size, args.lines, args.rounds))
@@ -1,5 +1,7 @@
 from pydantic import BaseModel
 from typing import Optional
+from dataclasses import dataclass, field
+import tomllib
 
 
 class JobConfig(BaseModel):
@@ -16,3 +18,54 @@ class JobConfig(BaseModel):
     image: Optional[str] = ''
     data_size: Optional[str] = ''
     node: Optional[str] = ''
+
+
+@dataclass(slots=True)
+class JobSpec:
+    name: str
+    upstream: str
+    provider: str = 'rsync'
+    command: str = ''
+    concurrent: int = 3
+    interval: int = 1440
+    rsync_options: list = field(default_factory=list)
+    memory_limit: str = ''
+    size_pattern: str = ''
+    addition_option: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_data(cls, name: str, data: dict) -> 'JobSpec':
+        options = data.get('rsync_options') or []
+        if not isinstance(options, list):
+            options = options.split()
+        return cls(name=name, upstream=data['upstream'], provider=data['provider'], command=data.get('command') or '',
+                   concurrent=int(data['concurrent']), interval=int(data['interval']),
+                   rsync_options=[i for i in options if i != '--info=progress2'],
+                   memory_limit=data.get('memory_limit') or '', size_pattern=data.get('size_pattern') or '',
+                   addition_option={i: str(j) for i, j in (data.get('addition_option') or {}).items()})
+
+    @classmethod
+    def from_conf(cls, conf: str) -> 'JobSpec':
+        data = tomllib.loads(conf)
+        mirror = data['mirrors'][0]
+        return cls(name=mirror['name'], upstream=mirror['upstream'], provider=mirror['provider'],
+                   command=mirror.get('command', ''), concurrent=int(data['global']['concurrent']),
+                   interval=int(data['global']['interval']),
+                   rsync_options=[i for i in mirror.get('rsync_options', []) if i != '--info=progress2'],
+                   memory_limit=mirror.get('memory_limit', ''), size_pattern=mirror.get('size_pattern', ''),
+                   addition_option={i: str(j) for i, j in mirror.get('env', {}).items()})
+
+    def to_dict(self) -> dict:
+        data = {'concurrent': self.concurrent, 'interval': self.interval, 'provider': self.provider,
+                'upstream': self.upstream}
+        if self.command:
+            data['command'] = self.command
+        if self.rsync_options:
+            data['rsync_options'] = list(self.rsync_options)
+        if self.memory_limit:
+            data['memory_limit'] = self.memory_limit
+        if self.size_pattern:
+            data['size_pattern'] = self.size_pattern
+        if self.addition_option:
+            data['addition_option'] = dict(self.addition_option)
+        return data
@@ -1,10 +1,74 @@
-from kubernetes_asyncio import client
+from kubernetes_asyncio import client, watch
 from kubernetes_asyncio.stream import WsApiClient
 from kubernetes_asyncio.client.rest import ApiException
 import aiohttp
 import asyncio
-from configobj import ConfigObj
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import tomllib
+from datetime import datetime, timezone
+from collections import deque
+from functools import wraps
+from urllib.parse import urlparse
+from prometheus_client import Histogram, Gauge
 import logging
+from models import JobSpec
+
+LOG_DIR = '/var/lib/tunasync'
+HASH_ANNOTATION = 'tunasync-kubernetes/config-hash'
+FIELD_MANAGER = 'tunasync-controller'
+RSYNC_LINE = re.compile(rb'\r\n|\r|\n')
+RSYNC_PROGRESS = re.compile(r'^\s*([\d,.]+[KMGTP]?)\s+(\d+%)\s+(\S+B/s)\s+(\S+)')
+RSYNC_CHECK = re.compile(r'\(xfr#(\d+),\s*\w+-chk=(\d+)/(\d+)\)')
+RSYNC_SIZE = re.compile(r'(\d+\.?\d+?[BKMGTP])')
+MANAGER_URI = re.compile(r'(?<=/workers)/[^/]+|(?<=/jobs)/(?!disabled)[^/]+')
+SYNC_ERRORS = [
+    ('disk', re.compile(r'No space left on device|Disk quota exceeded|Read-only file system', re.I)),
+    ('config', re.compile(r'@ERROR: (auth failed|unknown module|access denied)|command not found|'
+                          r'HTTP (error )?40[134]', re.I)),
+    ('overload', re.compile(r'max connections|too many (connections|requests)|HTTP (error )?(429|503)', re.I)),
+    ('network', re.compile(r'timed out|\btimeout\b(?!=)|connection (refused|reset|closed)|no route to host|'
+                           r'network is unreachable|name or service not known|temporary failure in name resolution|'
+                           r'error in socket IO|unexpected end of file', re.I)),
+    ('upstream', re.compile(r'rsync error|HTTP (error )?5\d\d|vanished|partial transfer', re.I)),
+]
+RSYNC_EXIT = re.compile(r'rsync error: .*\(code (\d+)\)')
+# 含义明确的 rsync 退出码，其余（如 5 协议启动失败、11 文件读写错误）按日志内容判断
+RSYNC_EXIT_ERRORS = {10: 'network', 12: 'network', 23: 'upstream', 24: 'upstream', 30: 'network', 35: 'network'}
+RSYNC_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+REQUEST_TIME = Histogram('controller_request_seconds', 'Time spent handling API requests',
+                         ['method', 'route', 'status'])
+KUBERNETES_TIME = Histogram('controller_kubernetes_seconds', 'Time spent in Kubernetes calls', ['call'])
+MANAGER_TIME = Histogram('controller_manager_seconds', 'Time spent in tunasync-manager requests', ['method', 'uri'])
+LOG_TIME = Histogram('controller_log_read_seconds', 'Time spent reading job logs', ['op'])
+JOB_SIZE = Gauge('tunasync_job_size_bytes', 'Mirror size', ['job'])
+JOB_STATUS = Gauge('tunasync_job_status', 'Current sync status of the job', ['job', 'status'])
+JOB_LAST_SUCCESS = Gauge('tunasync_job_last_success_timestamp_seconds', 'Last successful sync time', ['job'])
+JOB_FAILURES = Gauge('tunasync_job_consecutive_failures', 'Consecutive failed syncs', ['job', 'error'])
+JOB_THROUGHPUT = Gauge('tunasync_job_rsync_throughput_bytes', 'Average rsync throughput in bytes per second',
+                       ['job'])
+
+
+def timed(histogram: Histogram, *labels):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.labels(*labels).time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remove_metric(metric, *labels):
+    try:
+        metric.remove(*labels)
+    except KeyError:
+        pass
 
 
 class size_tools(object):
@@ -57,17 +121,226 @@ class size_tools(object):
             return 0
 
 
+def tail_offset(path: str, n: int, block: int = 64 * 1024) -> int:
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        if n <= 0:
+            return pos
+        # 末尾换行不算作新的一行
+        if pos:
+            f.seek(pos - 1)
+            if f.read(1) == b'\n':
+                pos -= 1
+        found = 0
+        while pos > 0:
+            size = min(block, pos)
+            pos -= size
+            f.seek(pos)
+            chunk = f.read(size)
+            idx = len(chunk)
+            while True:
+                idx = chunk.rfind(b'\n', 0, idx)
+                if idx < 0:
+                    break
+                found += 1
+                if found == n:
+                    return pos + idx + 1
+        return 0
+
+
+def tail(path: str, n: int, block: int = 64 * 1024) -> bytes:
+    if n <= 0:
+        return b''
+    offset = tail_offset(path, n, block)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read()
+
+
+async def read_log(path: str, offset: int = 0, follow: bool = False, interval: float = 1,
+                   block: int = 64 * 1024):
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        pos = await asyncio.to_thread(f.seek, offset)
+        rest = b''
+        while True:
+            chunk = await asyncio.to_thread(f.read, block)
+            if chunk:
+                chunk = rest + chunk
+                # 按行切分（rsync 进度以 \r 分隔），超长的行直接输出，保证内存占用恒定
+                end = max(chunk.rfind(b'\n'), chunk.rfind(b'\r')) + 1
+                if not end and len(chunk) >= block:
+                    end = len(chunk)
+                rest = chunk[end:]
+                if end:
+                    pos += end
+                    yield pos, chunk[:end]
+                continue
+            if not follow:
+                if rest:
+                    yield pos + len(rest), rest
+                return
+            await asyncio.sleep(interval)
+            try:
+                current = os.stat(path)
+            except OSError:
+                continue
+            opened = os.fstat(f.fileno())
+            # latest 指向了新的日志文件，或原文件被截断
+            if current.st_ino != opened.st_ino or current.st_dev != opened.st_dev:
+                # 分块读完旧文件的剩余部分
+                while True:
+                    chunk = await asyncio.to_thread(f.read, block)
+                    if not chunk:
+                        break
+                    pos += len(rest) + len(chunk)
+                    yield pos, rest + chunk
+                    rest = b''
+                if rest:
+                    yield pos + len(rest), rest
+                f.close()
+                f = await asyncio.to_thread(open, path, 'rb')
+                pos, rest = 0, b''
+            elif opened.st_size < pos + len(rest):
+                pos = await asyncio.to_thread(f.seek, 0)
+                rest = b''
+    finally:
+        f.close()
+
+
+def log_path(name: str) -> str:
+    if not name or name in ['.', '..'] or os.path.basename(name) != name:
+        raise ValueError(f'illegal job name {name!r}')
+    return os.path.join(LOG_DIR, name, 'latest')
+
+
+@timed(LOG_TIME, 'tail')
 async def get_last_n_lines(name: str, n: int) -> list:
-    args = "tail -n {} /var/lib/tunasync/{}/latest".format(n, name)
-    proc = await asyncio.create_subprocess_shell(args, stdout=asyncio.subprocess.PIPE,
-                                                 stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
+    try:
+        stdout = await asyncio.to_thread(tail, log_path(name), n)
+    except (OSError, ValueError) as e:
+        logging.debug(e)
+        return []
     if stdout:
-        return stdout.decode().split('\n')
+        return stdout.decode(errors='replace').split('\n')
     else:
         return []
 
 
+class RsyncProgress(object):
+    __slots__ = ('path', 'inode', 'offset', 'rest', 'transferred', 'size', 'rate', 'speed', 'remain', 'chk_now',
+                 'chk_remain', 'total', 'file_name', 'total_size', 'history')
+
+    def __init__(self, path: str, window: int = 30):
+        self.path = path
+        self.history = deque(maxlen=window)
+        self.reset()
+
+    def reset(self, inode: int = 0):
+        self.inode = inode
+        self.offset = 0
+        self.rest = b''
+        self.size = self.rate = self.speed = self.remain = self.file_name = self.total_size = ''
+        self.transferred = self.chk_now = self.chk_remain = self.total = 0
+        self.history.clear()
+
+    @staticmethod
+    def to_bytes(size: str) -> int:
+        size = size.replace(',', '')
+        try:
+            if size[-1:].upper() in RSYNC_UNITS:
+                return int(float(size[:-1]) * RSYNC_UNITS[size[-1].upper()])
+            return int(size)
+        except ValueError:
+            return 0
+
+    def parse(self, line: str, partial: bool = False):
+        progress = RSYNC_PROGRESS.match(line)
+        if progress:
+            self.size = size_tools.XB_XiB(progress.group(1))
+            self.rate, self.speed, self.remain = progress.group(2, 3, 4)
+            check = RSYNC_CHECK.search(line)
+            if check:
+                self.chk_now, self.chk_remain, self.total = (int(i) for i in check.groups())
+            self.transferred = self.to_bytes(progress.group(1))
+        elif not partial and line.strip():
+            if 'size' in line.lower():
+                size = RSYNC_SIZE.search(line)
+                if size and size_tools.XiB_MB(self.total_size) < size_tools.XiB_MB(size.group(1)):
+                    self.total_size = size.group(1)
+            self.file_name = line.split('/')[-1].strip()
+
+    def update(self, lines: int = 20, limit: int = 1024 * 1024, block: int = 64 * 1024):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.reset(stat.st_ino)
+            self.offset = tail_offset(self.path, lines)
+        elif stat.st_size - self.offset > limit:
+            # 落后太多时直接跳到末尾附近，不再逐字节追赶
+            self.offset = tail_offset(self.path, lines)
+            self.rest = b''
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while self.offset < stat.st_size:
+                chunk = f.read(min(block, stat.st_size - self.offset))
+                if not chunk:
+                    break
+                self.offset += len(chunk)
+                parts = RSYNC_LINE.split(self.rest + chunk)
+                self.rest = parts.pop()[-block:]
+                for i in parts:
+                    self.parse(i.decode(errors='replace'))
+        if self.rest:
+            self.parse(self.rest.decode(errors='replace'), partial=True)
+        if self.transferred and (not self.history or self.history[-1][1] != self.transferred):
+            self.history.append((time.monotonic(), self.transferred))
+
+    def throughput(self) -> float:
+        if len(self.history) < 2:
+            return 0
+        (start, begin), (end, now) = self.history[0], self.history[-1]
+        return (now - begin) / (end - start) if end > start else 0
+
+    def status(self) -> dict:
+        return {
+            'rsync_size': self.size,
+            'file_name': self.file_name,
+            'remain': self.remain,
+            'speed': self.speed,
+            'rate': self.rate,
+            'chk_now': self.chk_now,
+            'chk_remain': self.chk_remain,
+            'total': self.total,
+            'throughput': round(self.throughput(), 2)
+        }
+
+
+class ProgressTracker(object):
+    def __init__(self):
+        self.jobs = {}
+        self.locks = {}
+
+    @timed(LOG_TIME, 'progress')
+    async def get(self, name: str) -> RsyncProgress:
+        if name not in self.jobs:
+            self.jobs[name] = RsyncProgress(log_path(name))
+            self.locks[name] = asyncio.Lock()
+        job = self.jobs[name]
+        # update 在线程中修改 offset 等状态，同一任务的并发调用需串行
+        async with self.locks[name]:
+            await asyncio.to_thread(job.update)
+        JOB_THROUGHPUT.labels(name).set(job.throughput())
+        return job
+
+    def remove(self, name: str):
+        self.jobs.pop(name, None)
+        self.locks.pop(name, None)
+        remove_metric(JOB_THROUGHPUT, name)
+
+
 def check_num(p) -> bool:
     try:
         return True if p and int(p) > 0 else False
@@ -75,6 +348,24 @@ def check_num(p) -> bool:
         return False
 
 
+TOML_BARE_KEY = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def toml_key(key: str) -> str:
+    return key if TOML_BARE_KEY.fullmatch(key) else toml_value(key)
+
+
+def toml_value(value) -> str:
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, list):
+        return '[' + ', '.join(toml_value(i) for i in value) + ']'
+    # JSON 字符串即 TOML 基本字符串，仅 DEL 需额外转义
+    return json.dumps(str(value), ensure_ascii=False).replace('\x7f', '\\u007f')
+
+
 class Conf:
     @staticmethod
     def pvc(name: str, args: dict) -> dict:
@@ -127,38 +418,34 @@ class Conf:
 
     @staticmethod
     def cm(name: str, args: dict) -> dict:
-        mirror_conf = ConfigObj(list_values=False)
-        mirror_conf['global'] = {'name': f'"{name}"', 'mirror_dir': '"/data/mirrors"',
-                                 'log_dir': f'"/var/log/tunasync/{name}"', 'retry': 3,
-                                 'concurrent': args['data']['concurrent'], 'interval': args['data']['interval']}
-        mirror_conf['manager'] = {'api_base': f'"{args["manager"]}"'}
-        mirror_conf['cgroup'] = {'enable': 'false', 'base_path': '""', 'group': '""'}
-        mirror = {'name': f'"{name}"', 'provider': f'"{args["data"]["provider"]}"',
-                  'upstream': f'"{args["data"]["upstream"]}"', 'use_ipv6': 'false'}
-        if args['data']['provider'] == 'command':
-            mirror['command'] = f'"{args["data"]["command"]}"'
-        elif 'rsync' in args['data']['provider']:
-            if isinstance(args['data']['rsync_options'], list):
-                op = args['data']['rsync_options']
-            else:
-                op = args['data']['rsync_options'].split()
-            if '--info=progress2' not in op:
-                op.append('--info=progress2')
-            mirror['rsync_options'] = str(op).replace('\'', '"')
-            if args['data']['provider'] == 'two-stage-rsync':
-                mirror['stage1_profile'] = '"debian"'
+        spec = args['data'] if isinstance(args['data'], JobSpec) else JobSpec.from_data(name, args['data'])
+        conf = [('global', {'name': name, 'mirror_dir': '/data/mirrors', 'log_dir': f'/var/log/tunasync/{name}',
+                            'retry': 3, 'concurrent': spec.concurrent, 'interval': spec.interval}),
+                ('manager', {'api_base': args['manager']}),
+                ('cgroup', {'enable': False, 'base_path': '', 'group': ''}),
+                ('server', {'hostname': name, 'listen_addr': '0.0.0.0', 'listen_port': 6000, 'ssl_cert': '',
+                            'ssl_key': ''})]
+        mirror = {'name': name, 'provider': spec.provider, 'upstream': spec.upstream, 'use_ipv6': False}
+        if spec.provider == 'command':
+            mirror['command'] = spec.command
+        elif 'rsync' in spec.provider:
+            mirror['rsync_options'] = spec.rsync_options + ['--info=progress2']
+            if spec.provider == 'two-stage-rsync':
+                mirror['stage1_profile'] = 'debian'
         else:
             pass
-        if args['data']['memory_limit']:
-            mirror['memory_limit'] = f'"{args["data"]["memory_limit"]}"'
-        if args['data']['size_pattern']:
-            mirror['size_pattern'] = f'"{args["data"]["size_pattern"]}"'.replace('\\', '\\\\')
-        mirror_conf['server'] = {'hostname': f'"{name}"', 'listen_addr': '"0.0.0.0"',
-                                 'listen_port': '6000', 'ssl_cert': '""', 'ssl_key': '""', 'mirrors': mirror}
-        if args['data']['addition_option']:
-            mirror_conf['mirrors.env'] = {}
-            for i in args['data']['addition_option']:
-                mirror_conf['mirrors.env'][i] = f'"{args["data"]["addition_option"][i]}"'
+        if args.get('fallback'):
+            # 由控制器统一调度，worker 自身的定时同步仅作兜底
+            mirror['interval'] = spec.interval * args['fallback']
+        if spec.memory_limit:
+            mirror['memory_limit'] = spec.memory_limit
+        if spec.size_pattern:
+            mirror['size_pattern'] = spec.size_pattern
+        conf.append(('[mirrors]', mirror))
+        if spec.addition_option:
+            conf.append(('mirrors.env', {i: str(j) for i, j in spec.addition_option.items()}))
+        worker_conf = ''.join(f'[{section}]\n' + ''.join(f'{toml_key(i)} = {toml_value(j)}\n' for i, j in table.items())
+                              for section, table in conf)
         data = {
             'kind': 'ConfigMap',
             'apiVersion': 'v1',
@@ -167,7 +454,7 @@ class Conf:
                 'namespace': args['namespace']
             },
             'data': {
-                'worker.conf': '\n'.join(mirror_conf.write())
+                'worker.conf': worker_conf
             }
         }
         return data
@@ -314,8 +601,137 @@ class Conf:
         return data
 
 
+async def cancel_task(task: asyncio.Task | None):
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+class BackgroundTask(object):
+    """在后台运行 run()，start 启动，stop 取消并等待其退出"""
+    task = None
+
+    async def run(self):
+        raise NotImplementedError
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self.task)
+        self.task = None
+
+
+class PeriodicTask(BackgroundTask):
+    """每 tick 秒执行一次 schedule()，单次失败只记录日志"""
+    tick = 30
+
+    async def schedule(self):
+        raise NotImplementedError
+
+    async def run(self):
+        while True:
+            try:
+                await self.schedule()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(e)
+            await asyncio.sleep(self.tick)
+
+
+class Informer(BackgroundTask):
+    def __init__(self, list_func, namespace: str, resync: int = 300):
+        self.list_func = list_func
+        self.namespace = namespace
+        self.resync = resync
+        self.items = {}
+        self.labels = {}
+        self.resource_version = ''
+        self.synced = False
+        self.task = None
+
+    @staticmethod
+    def _app(obj) -> str:
+        return (obj.metadata.labels or {}).get('app', '')
+
+    def _version(self, obj) -> int:
+        try:
+            return int(obj.metadata.resource_version)
+        except (TypeError, ValueError):
+            return 0
+
+    def update(self, obj):
+        name = obj.metadata.name
+        old = self.items.get(name)
+        if old is not None:
+            if self._version(old) > self._version(obj):
+                return
+            self.labels.get(self._app(old), set()).discard(name)
+        self.items[name] = obj
+        self.labels.setdefault(self._app(obj), set()).add(name)
+
+    def remove(self, name: str):
+        old = self.items.pop(name, None)
+        if old is not None:
+            self.labels.get(self._app(old), set()).discard(name)
+
+    def get(self, name: str):
+        return self.items.get(name)
+
+    def by_app(self, app: str) -> list:
+        return [self.items[i] for i in sorted(self.labels.get(app, ()))]
+
+    def list(self) -> list:
+        return [self.items[i] for i in sorted(self.items)]
+
+    async def relist(self):
+        resp = await self.list_func(self.namespace, _request_timeout=10)
+        self.items = {}
+        self.labels = {}
+        for i in resp.items:
+            self.update(i)
+        self.resource_version = resp.metadata.resource_version
+        self.synced = True
+
+    async def run(self):
+        while True:
+            try:
+                await self.relist()
+                w = watch.Watch()
+                async with w.stream(self.list_func, self.namespace, resource_version=self.resource_version,
+                                    allow_watch_bookmarks=True, timeout_seconds=self.resync,
+                                    _request_timeout=self.resync + 30) as stream:
+                    async for event in stream:
+                        if event['type'] == 'DELETED':
+                            self.remove(event['object'].metadata.name)
+                        elif event['type'] in ['ADDED', 'MODIFIED']:
+                            self.update(event['object'])
+                        self.resource_version = w.resource_version
+            except asyncio.CancelledError:
+                raise
+            except ApiException as e:
+                # 410 Gone 说明 resourceVersion 已过期，下一轮重新 list 即可
+                if e.status != 410:
+                    logging.warning(e)
+                    self.synced = False
+                    await asyncio.sleep(5)
+            except Exception as e:
+                logging.warning(e)
+                self.synced = False
+                await asyncio.sleep(5)
+
+    async def stop(self):
+        await super().stop()
+        self.synced = False
+
+
 class Kubernetes(object):
-    def __init__(self, host: str, token: str, ca: str = None, namespace: str = 'default'):
+    def __init__(self, host: str, token: str, ca: str = None, namespace: str = 'default', server_side: bool = True):
         configuration = client.Configuration()
         configuration.api_key['BearerToken'] = "Bearer " + token
         configuration.host = host
@@ -326,6 +742,7 @@ class Kubernetes(object):
         self.api_client = client.ApiClient(configuration)
         self.auth_settings = ['BearerToken']
         self.namespace = namespace
+        self.server_side = server_side
         self.api_instance = client.CoreV1Api(self.api_client)
         self.command = {
             'pvc': {
@@ -333,6 +750,7 @@ class Kubernetes(object):
                 'get': self.api_instance.read_namespaced_persistent_volume_claim,
                 'patch': self.api_instance.patch_namespaced_persistent_volume_claim,
                 'create': self.api_instance.create_namespaced_persistent_volume_claim,
+                'delete': self.api_instance.delete_namespaced_persistent_volume_claim,
                 'config': Conf.pvc
             },
             'cm': {
@@ -375,7 +793,40 @@ class Kubernetes(object):
                 'exec': client.CoreV1Api(api_client=WsApiClient(configuration)).connect_get_namespaced_pod_exec
             }
         }
+        self.informers = {i: Informer(self.command[i]['list'], self.namespace) for i in ['pod', 'deploy', 'pvc', 'cm']}
+        self.specs = {}
+        self.usage = {}
+        self.usage_expire = 0
+        self.usage_lock = asyncio.Lock()
+
+    def start(self):
+        for i in self.informers.values():
+            i.start()
 
+    async def stop(self):
+        for i in self.informers.values():
+            await i.stop()
+
+    def cache(self, mode: str) -> Informer | None:
+        if mode in self.informers and self.informers[mode].synced:
+            return self.informers[mode]
+        return None
+
+    def observe(self, mode: str, obj=None, name: str = ''):
+        if mode not in self.informers:
+            return
+        if obj is not None and getattr(obj, 'metadata', None):
+            self.informers[mode].update(obj)
+        elif name:
+            self.informers[mode].remove(name)
+
+    async def cached_get(self, mode: str, name: str):
+        cache = self.cache(mode)
+        if cache:
+            return cache.get(name)
+        return await self.command[mode]['get'](name, namespace=self.namespace, _request_timeout=3)
+
+    @timed(KUBERNETES_TIME, 'get')
     async def get(self, mode: str, name: str):
         try:
             return await self.command[mode]['get'](name, self.namespace, _request_timeout=3)
@@ -386,21 +837,49 @@ class Kubernetes(object):
                 logging.warning(e)
             return None
 
+    @timed(KUBERNETES_TIME, 'exists')
+    async def exists(self, mode: str, name: str) -> bool:
+        cache = self.cache(mode)
+        if cache:
+            return cache.get(name) is not None
+        try:
+            await self.command[mode]['get'](name, self.namespace, _request_timeout=3)
+            return True
+        except ApiException as e:
+            # 无法确认时按已存在处理，避免回滚误删
+            return e.status != 404
+
+    @timed(KUBERNETES_TIME, 'apply')
     async def apply(self, mode: str, name: str, **kwargs) -> bool:
         kwargs['namespace'] = self.namespace
+        config = self.command[mode]['config'](name, kwargs)
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        config['metadata'].setdefault('annotations', {})[HASH_ANNOTATION] = digest
         try:
-            if await self.get(mode, name):
-                await self.command[mode]['patch'](name, self.namespace, self.command[mode]['config'](name, kwargs),
-                                                  _request_timeout=3)
+            ori = None
+            cache = self.cache(mode)
+            if cache:
+                ori = cache.get(name)
+            elif not self.server_side:
+                ori = await self.get(mode, name)
+            if ori and (ori.metadata.annotations or {}).get(HASH_ANNOTATION) == digest:
+                logging.debug(f'{mode} {name} 无变化，跳过')
                 return True
+            if self.server_side:
+                resp = await self.command[mode]['patch'](name, self.namespace, config, field_manager=FIELD_MANAGER,
+                                                         force=True, _content_type='application/apply-patch+yaml',
+                                                         _request_timeout=3)
+            elif ori:
+                resp = await self.command[mode]['patch'](name, self.namespace, config, _request_timeout=3)
             else:
-                await self.command[mode]['create'](self.namespace, self.command[mode]['config'](name, kwargs),
-                                                   _request_timeout=3)
-                return True
+                resp = await self.command[mode]['create'](self.namespace, config, _request_timeout=3)
+            self.observe(mode, resp)
+            return True
         except ApiException as e:
             logging.warning(e)
             return False
 
+    @timed(KUBERNETES_TIME, 'delete')
     async def delete(self, mode: str, name: str, force: bool = False) -> bool:
         try:
             if force:
@@ -409,11 +888,13 @@ class Kubernetes(object):
                     del ori.metadata.finalizers
                     await self.command[mode]['patch'](name, self.namespace, ori, _request_timeout=3)
             await self.command[mode]['delete'](name, self.namespace, grace_period_seconds=0, _request_timeout=3)
+            self.observe(mode, name=name)
             return True
         except ApiException as e:
             logging.warning(e)
             return False
 
+    @timed(KUBERNETES_TIME, 'exec')
     async def exec(self, pod_name: str, cmd: list) -> str:
         try:
             api_response = await self.command['pod']['exec'](pod_name, self.namespace, command=cmd, stderr=True,
@@ -423,6 +904,7 @@ class Kubernetes(object):
             logging.warning(e)
             return ''
 
+    @timed(KUBERNETES_TIME, 'log')
     async def log(self, pod_name: str) -> str:
         try:
             return await self.api_instance.read_namespaced_pod_log(pod_name, self.namespace, _request_timeout=3)
@@ -430,40 +912,63 @@ class Kubernetes(object):
             logging.warning(e)
             return ''
 
+    @staticmethod
+    def pod_info(resp) -> dict:
+        statuses = resp.status.container_statuses or []
+        return {
+            'name': resp.metadata.name,
+            'node': resp.spec.node_name,
+            'status': resp.status.phase,
+            'image': statuses[0].image if statuses else '',
+            'ready': statuses[0].ready if statuses else False
+        }
+
+    @timed(KUBERNETES_TIME, 'pod')
     async def pod(self, pod_name: str = '', name: str = '', ready: bool = False) -> dict | list:
         try:
+            cache = self.cache('pod')
             if pod_name:
-                resp = await self.command['pod']['get'](pod_name, namespace=self.namespace, _request_timeout=3)
-                data = {
-                    'node': resp.spec.node_name,
-                    'status': resp.status.phase,
-                    'image': resp.status.container_statuses[0].image,
-                    'ready': resp.status.container_statuses[0].ready
-                }
+                resp = await self.cached_get('pod', pod_name)
+                if not resp:
+                    return {}
+                data = self.pod_info(resp)
+                del data['name']
                 return data
             else:
-                data = []
-                if name:
-                    resp = await self.command['pod']['list'](namespace=self.namespace, label_selector=f"app={name}",
-                                                             timeout_seconds=3, _request_timeout=3)
+                if cache:
+                    items = cache.by_app(name) if name else cache.list()
+                elif name:
+                    items = (await self.command['pod']['list'](namespace=self.namespace, label_selector=f"app={name}",
+                                                               timeout_seconds=3, _request_timeout=3)).items
                 else:
-                    resp = await self.command['pod']['list'](namespace=self.namespace, timeout_seconds=3,
-                                                             _request_timeout=3)
-                for i in resp.items:
-                    if ready and not i.status.container_statuses[0].ready:
-                        continue
-                    data.append({
-                        'name': i.metadata.name,
-                        'node': i.spec.node_name,
-                        'status': i.status.phase,
-                        'image': i.status.container_statuses[0].image,
-                        'ready': i.status.container_statuses[0].ready
-                    })
+                    items = (await self.command['pod']['list'](namespace=self.namespace, timeout_seconds=3,
+                                                               _request_timeout=3)).items
+                data = [self.pod_info(i) for i in items]
+                if ready:
+                    data = [i for i in data if i['ready']]
                 return data
         except ApiException as e:
             logging.warning(e)
             return {}
 
+    @timed(KUBERNETES_TIME, 'pods')
+    async def pods(self) -> dict:
+        try:
+            cache = self.cache('pod')
+            if cache:
+                items = cache.list()
+            else:
+                items = (await self.command['pod']['list'](namespace=self.namespace, timeout_seconds=3,
+                                                           _request_timeout=3)).items
+            data = {}
+            for i in items:
+                data.setdefault((i.metadata.labels or {}).get('app', ''), []).append(self.pod_info(i))
+            return data
+        except ApiException as e:
+            logging.warning(e)
+            return {}
+
+    @timed(KUBERNETES_TIME, 'top')
     async def top(self, pod_name: str = '') -> dict | list:
         try:
             api = f'/apis/metrics.k8s.io/v1beta1/namespaces/{self.namespace}/pods'
@@ -482,7 +987,7 @@ class Kubernetes(object):
                 ret = await self.api_client.call_api(api, 'GET', _preload_content=False, _request_timeout=3,
                                                      auth_settings=self.auth_settings)
                 if ret.status == 200:
-                    data = {i['metadata']['name']: i['containers'][0] for i in (await ret.json()['items']) if
+                    data = {i['metadata']['name']: i['containers'][0] for i in (await ret.json())['items'] if
                             i['containers']}
                     return data
                 else:
@@ -491,14 +996,35 @@ class Kubernetes(object):
             logging.warning(e)
             return []
 
+    @timed(KUBERNETES_TIME, 'config')
     async def config(self, name: str) -> str:
         try:
-            resp = await self.command['cm']['get'](name, namespace=self.namespace, _request_timeout=3)
-            return resp.data['worker.conf']
+            resp = await self.cached_get('cm', name)
+            return resp.data['worker.conf'] if resp and resp.data else ''
         except ApiException as e:
             logging.warning(e)
             return ''
 
+    @timed(KUBERNETES_TIME, 'spec')
+    async def spec(self, name: str) -> JobSpec | None:
+        try:
+            resp = await self.cached_get('cm', name)
+        except ApiException as e:
+            logging.warning(e)
+            return None
+        if not resp or not resp.data or 'worker.conf' not in resp.data:
+            self.specs.pop(name, None)
+            return None
+        version = resp.metadata.resource_version
+        if name not in self.specs or self.specs[name][0] != version:
+            try:
+                self.specs[name] = (version, JobSpec.from_conf(resp.data['worker.conf']))
+            except (tomllib.TOMLDecodeError, KeyError, IndexError, ValueError) as e:
+                logging.warning(f'{name} 配置文件解析失败: {e!r}')
+                return None
+        return self.specs[name][1]
+
+    @timed(KUBERNETES_TIME, 'nodes')
     async def nodes(self) -> list:
         try:
             resp = await self.api_instance.list_node(timeout_seconds=3, _request_timeout=3)
@@ -508,19 +1034,23 @@ class Kubernetes(object):
             logging.warning(e)
             return []
 
+    @timed(KUBERNETES_TIME, 'pvc_size')
     async def pvc_size(self, name: str) -> str:
         try:
-            resp = await self.command['pvc']['get'](name, namespace=self.namespace, _request_timeout=3)
-            return resp.spec.resources.requests['storage']
+            resp = await self.cached_get('pvc', name)
+            return resp.spec.resources.requests['storage'] if resp else ''
         except ApiException as e:
             logging.warning(e)
             return ''
 
+    @timed(KUBERNETES_TIME, 'deploy_node_image')
     async def deploy_node_image(self, name: str) -> (str, str):
         try:
-            resp = await self.command['deploy']['get'](name, namespace=self.namespace, _request_timeout=3)
+            resp = await self.cached_get('deploy', name)
+            if not resp:
+                return '', ''
             try:
-                node = resp.spec.template.spec.nodeSelector['kubernetes.io/hostname']
+                node = resp.spec.template.spec.node_selector['kubernetes.io/hostname']
             except:
                 node = ''
             image = resp.spec.template.spec.containers[0].image
@@ -529,6 +1059,39 @@ class Kubernetes(object):
             logging.warning(e)
             return '', ''
 
+    async def __summary__(self, node: str) -> dict:
+        usage = {}
+        try:
+            ret = await self.api_client.call_api(f'/api/v1/nodes/{node}/proxy/stats/summary', 'GET',
+                                                 _preload_content=False, _request_timeout=3,
+                                                 auth_settings=self.auth_settings)
+            if ret.status != 200:
+                raise ApiException(status=ret.status)
+            for pod in (await ret.json())['pods']:
+                for volume in pod.get('volume', []):
+                    pvc = volume.get('pvcRef')
+                    if pvc and pvc['namespace'] == self.namespace and 'usedBytes' in volume:
+                        usage[pvc['name']] = max(usage.get(pvc['name'], 0), volume['usedBytes'])
+        except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f'{node} 获取卷用量失败: {e!r}')
+        return usage
+
+    @timed(KUBERNETES_TIME, 'volume_usage')
+    async def volume_usage(self, ttl: int = 30) -> dict:
+        async with self.usage_lock:
+            if time.monotonic() < self.usage_expire:
+                return self.usage
+            nodes = {i['node'] for pods in (await self.pods()).values() for i in pods if i['node']}
+            usage = {}
+            # 只读挂载了全部储存卷的前端会让同一个 PVC 出现在多个节点上，取最大值
+            for node in await asyncio.gather(*[self.__summary__(i) for i in nodes]):
+                for name, used in node.items():
+                    usage[name] = max(usage.get(name, 0), used)
+            self.usage = usage
+            self.usage_expire = time.monotonic() + ttl
+            return usage
+
+    @timed(KUBERNETES_TIME, 'restart')
     async def restart(self, name: str) -> bool:
         success = True
         pods = await self.pod(name=name)
@@ -538,22 +1101,552 @@ class Kubernetes(object):
         return success
 
 
+class SizeScheduler(PeriodicTask):
+    def __init__(self, tunasync, collect, active: int = 300, idle: int = 3600, concurrency: int = 5,
+                 tick: int = 10):
+        self.tunasync = tunasync
+        self.collect = collect
+        self.active = active
+        self.idle = idle
+        self.tick = tick
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.sizes = {}
+        self.status = {}
+        self.due = {}
+        self.running = {}
+        self.task = None
+
+    def get(self, name: str) -> str:
+        return self.sizes.get(name, '')
+
+    def interval(self, status: str) -> int:
+        return self.active if status == 'syncing' else self.idle
+
+    async def refresh(self, name: str, force: bool = False) -> bool:
+        async with self.semaphore:
+            size = await self.collect(name)
+        success = True
+        if force or (size and size != self.sizes.get(name)):
+            success = await self.tunasync.set_size(name, name, size)
+            if success:
+                logging.debug(f'{name} 当前大小为 {size}，更新数据库成功')
+            else:
+                logging.warning(f'{name} 当前大小为 {size}，更新数据库失败')
+        if success and size:
+            self.sizes[name] = size
+            JOB_SIZE.labels(name).set(size_tools.XiB_MB(size) * 1024 * 1024)
+        return success
+
+    async def __refresh__(self, name: str):
+        try:
+            await self.refresh(name)
+        except Exception as e:
+            logging.warning(f'{name} 大小更新失败: {e!r}')
+        finally:
+            self.due[name] = time.monotonic() + self.interval(self.status.get(name, ''))
+            self.running.pop(name, None)
+
+    async def schedule(self):
+        data = await self.tunasync.jobs()
+        jobs = {i['name']: i.get('status', '') for i in data}
+        for i in data:
+            if i.get('last_update_ts', 0) > 0:
+                JOB_LAST_SUCCESS.labels(i['name']).set(i['last_update_ts'])
+        for name in set(self.status) - set(jobs):
+            remove_metric(JOB_STATUS, name, self.status[name])
+            remove_metric(JOB_SIZE, name)
+            remove_metric(JOB_LAST_SUCCESS, name)
+        for name in set(self.sizes) - set(jobs):
+            del self.sizes[name]
+        for name in set(self.due) - set(jobs):
+            del self.due[name]
+        now = time.monotonic()
+        for name, status in jobs.items():
+            # 状态变化（如同步结束）时立即更新一次
+            if self.status.get(name) != status:
+                self.due[name] = now
+                if name in self.status:
+                    remove_metric(JOB_STATUS, name, self.status[name])
+                JOB_STATUS.labels(name, status).set(1)
+            self.status[name] = status
+            if name not in self.running and self.due.get(name, now) <= now:
+                self.running[name] = asyncio.create_task(self.__refresh__(name))
+        self.status = {i: self.status[i] for i in jobs}
+
+    async def stop(self):
+        await super().stop()
+        for i in list(self.running.values()):
+            i.cancel()
+        self.running = {}
+
+
+class FrontReconciler(object):
+    def __init__(self, tunasync, apply, window: float = 10, max_wait: float = 60, resync: float = 60):
+        self.tunasync = tunasync
+        self.apply = apply
+        self.window = window
+        self.max_wait = max_wait
+        self.resync = resync
+        self.added = set()
+        self.removed = set()
+        self.applied = None
+        self.first = self.last = 0
+        self.lock = asyncio.Lock()
+        self.active = False
+        self.task = None
+        self.resync_task = None
+
+    def add(self, name: str):
+        # 非 leader 上的变化由成为 leader 后的对账获取，不在本地记录
+        if not self.active:
+            return
+        self.removed.discard(name)
+        self.added.add(name)
+        self.trigger()
+
+    def remove(self, name: str):
+        if not self.active:
+            return
+        self.added.discard(name)
+        self.removed.add(name)
+        self.trigger()
+
+    def trigger(self):
+        if not self.active:
+            return
+        now = time.monotonic()
+        if not self.task:
+            self.first = now
+            self.task = asyncio.create_task(self.__wait__())
+        self.last = now
+
+    async def __wait__(self):
+        # 窗口内没有新的事件，或距第一个事件超过 max_wait 时才真正更新
+        while True:
+            delay = min(self.last + self.window, self.first + self.max_wait) - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self.task = None
+        # 失败时不立即重试，交由 __resync__ 定期重新对账
+        try:
+            if not await self.reconcile():
+                logging.warning(f'前端更新失败，{self.resync} 秒后重试')
+        except Exception as e:
+            logging.warning(e)
+
+    async def desired(self) -> list:
+        workers = {i['id'] for i in await self.tunasync.workers()}
+        self.added -= workers
+        self.removed &= workers
+        return sorted((workers | self.added) - self.removed)
+
+    async def reconcile(self, force: bool = False) -> bool:
+        async with self.lock:
+            names = await self.desired()
+            if not force and names == self.applied:
+                logging.debug('前端挂载无变化，跳过')
+                return True
+            if await self.apply(names):
+                self.applied = names
+                return True
+            return False
+
+    async def __resync__(self):
+        # 其他副本上发生的变化由定期对账补上
+        while True:
+            await asyncio.sleep(self.resync)
+            self.trigger()
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        self.added.clear()
+        self.removed.clear()
+        self.resync_task = asyncio.create_task(self.__resync__())
+        self.trigger()
+
+    async def stop(self):
+        self.active = False
+        for task in [self.task, self.resync_task]:
+            await cancel_task(task)
+        self.task = self.resync_task = None
+        self.applied = None
+
+
+class SyncScheduler(PeriodicTask):
+    def __init__(self, tunasync, spec, nodes, concurrency: int = 10, per_host: int = 2, per_node: int = 4,
+                 jitter: float = 60, tick: int = 30, gate=None):
+        self.tunasync = tunasync
+        self.spec = spec
+        self.nodes = nodes
+        self.gate = gate
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.per_node = per_node
+        self.jitter = jitter
+        self.tick = tick
+        self.pending = {}
+        self.starting = set()
+        self.task = None
+
+    @staticmethod
+    def host(upstream: str) -> str:
+        return urlparse(upstream).hostname or upstream
+
+    async def __start__(self, name: str, delay: float):
+        try:
+            # 错开启动时间，避免同一时刻集中拉取
+            await asyncio.sleep(delay)
+            if await self.tunasync.cmd(name, 'start'):
+                logging.info(f'{name} 开始同步')
+            else:
+                self.pending.pop(name, None)
+        except asyncio.CancelledError:
+            self.pending.pop(name, None)
+            raise
+
+    async def schedule(self):
+        data, nodes = await asyncio.gather(self.tunasync.jobs(), self.nodes())
+        now = time.time()
+        running, hosts, per_node, candidates = 0, {}, {}, []
+        for job in data:
+            name = job['name']
+            if job.get('status') in ('syncing', 'pre-syncing'):
+                self.pending.pop(name, None)
+            elif name in self.pending and now - self.pending[name] > self.jitter + 120:
+                self.pending.pop(name, None)
+            host, node = self.host(job.get('upstream', '')), nodes.get(name, '')
+            if job.get('status') in ('syncing', 'pre-syncing') or name in self.pending:
+                running += 1
+                hosts[host] = hosts.get(host, 0) + 1
+                per_node[node] = per_node.get(node, 0) + 1
+                continue
+            if job.get('status') not in ('success', 'failed', 'none', ''):
+                continue
+            spec = await self.spec(name)
+            if not spec:
+                continue
+            interval = spec.interval * 60
+            if now < (job.get('last_ended_ts') or job.get('last_update_ts') or 0) + interval:
+                continue
+            # 按过期程度排序，从未成功过的最优先
+            last = job.get('last_update_ts') or 0
+            stale = (now - last) / interval if last > 0 else float('inf')
+            candidates.append((stale, name, host, node))
+        candidates.sort(key=lambda i: i[0], reverse=True)
+        for _, name, host, node in candidates:
+            if running >= self.concurrency:
+                break
+            if hosts.get(host, 0) >= self.per_host or (node and per_node.get(node, 0) >= self.per_node):
+                continue
+            if self.gate and not self.gate(host):
+                continue
+            running += 1
+            hosts[host] = hosts.get(host, 0) + 1
+            per_node[node] = per_node.get(node, 0) + 1
+            self.pending[name] = now
+            task = asyncio.create_task(self.__start__(name, random.uniform(0, self.jitter)))
+            self.starting.add(task)
+            task.add_done_callback(self.starting.discard)
+
+    async def stop(self):
+        await super().stop()
+        for i in list(self.starting):
+            i.cancel()
+        self.pending = {}
+
+
+class RetryEngine(PeriodicTask):
+    # 磁盘、配置类错误重试也无济于事，等待人工处理或下次定时同步
+    fatal = ('disk', 'config')
+
+    def __init__(self, tunasync, path: str, base: int = 60, cap: int = 3600, threshold: int = 3,
+                 cooldown: int = 600, tick: int = 15):
+        self.tunasync = tunasync
+        self.path = path
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.tick = tick
+        self.jobs = {}
+        self.hosts = {}
+        self.task = None
+
+    @staticmethod
+    def classify(lines: list) -> str:
+        text = '\n'.join(lines)
+        codes = RSYNC_EXIT.findall(text)
+        if codes and int(codes[-1]) in RSYNC_EXIT_ERRORS and not SYNC_ERRORS[0][1].search(text):
+            return RSYNC_EXIT_ERRORS[int(codes[-1])]
+        for name, pattern in SYNC_ERRORS:
+            if pattern.search(text):
+                return name
+        return 'unknown'
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.jobs, self.hosts = data.get('jobs', {}), data.get('hosts', {})
+            for name, state in self.jobs.items():
+                JOB_FAILURES.labels(name, state['error']).set(state['failures'])
+        except (OSError, ValueError) as e:
+            logging.debug(e)
+
+    def save(self):
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'jobs': self.jobs, 'hosts': self.hosts}, f)
+        os.replace(temp, self.path)
+
+    def allow(self, host: str, now: float = None) -> bool:
+        breaker = self.hosts.get(host)
+        if not breaker or not breaker['open']:
+            return True
+        # 冷却结束后半开，只放行一次试探
+        return (now or time.time()) >= breaker['open'] and not breaker['probe']
+
+    def __failure__(self, name: str, host: str, ended: float, error: str, now: float):
+        state = self.jobs.setdefault(name, {'failures': 0})
+        if 'error' in state:
+            remove_metric(JOB_FAILURES, name, state['error'])
+        state.update(failures=state['failures'] + 1, error=error, ended=ended, host=host)
+        JOB_FAILURES.labels(name, error).set(state['failures'])
+        if error in self.fatal:
+            state['next'] = None
+        else:
+            delay = min(self.cap, self.base * 2 ** (state['failures'] - 1))
+            state['next'] = now + delay * random.uniform(0.5, 1.5)
+        breaker = self.hosts.get(host)
+        if error in ('network', 'overload', 'upstream') or (breaker and breaker['probe']):
+            breaker = self.hosts.setdefault(host, {'failures': 0, 'open': 0, 'probe': False, 'cooldown': 0})
+            breaker['failures'] += 1
+            if breaker['open'] or breaker['failures'] >= self.threshold:
+                # 试探失败时冷却时间翻倍
+                breaker['cooldown'] = min(self.cap * 4, breaker['cooldown'] * 2 if breaker['open'] else self.cooldown)
+                breaker['open'] = now + breaker['cooldown']
+                breaker['probe'] = False
+                logging.warning(f'{host} 连续失败，暂停重试 {breaker["cooldown"]} 秒')
+        logging.info(f'{name} 第 {state["failures"]} 次失败 ({error})，下次重试: {state["next"]}')
+
+    def __success__(self, name: str, host: str):
+        state = self.jobs.pop(name, None)
+        if state:
+            remove_metric(JOB_FAILURES, name, state.get('error', ''))
+        if host in self.hosts:
+            del self.hosts[host]
+
+    async def schedule(self):
+        data = await self.tunasync.jobs()
+        now = time.time()
+        changed = False
+        jobs = {i['name']: i for i in data}
+        for name in set(self.jobs) - set(jobs):
+            remove_metric(JOB_FAILURES, name, self.jobs.pop(name).get('error', ''))
+            changed = True
+        for name, job in jobs.items():
+            host = SyncScheduler.host(job.get('upstream', ''))
+            state = self.jobs.get(name)
+            ended = job.get('last_ended_ts') or job.get('last_update_ts') or 0
+            if job.get('status') == 'success' and (state or host in self.hosts):
+                self.__success__(name, host)
+                changed = True
+            elif job.get('status') == 'failed' and (not state or state.get('ended') != ended):
+                self.__failure__(name, host, ended, self.classify(await get_last_n_lines(name, 30)), now)
+                changed = True
+        for name, state in self.jobs.items():
+            job = jobs[name]
+            if job.get('status') != 'failed' or state['next'] is None or now < state['next']:
+                continue
+            if not self.allow(state['host'], now):
+                continue
+            breaker = self.hosts.get(state['host'])
+            if breaker and breaker['open']:
+                breaker['probe'] = True
+            state['next'] = None
+            changed = True
+            if await self.tunasync.cmd(name, 'start'):
+                logging.info(f'{name} 重新开始同步')
+            else:
+                state['next'] = now + self.base
+        if changed:
+            await asyncio.to_thread(self.save)
+
+    async def sync(self):
+        # 状态保存在共享存储中，非主节点使用前重新读取
+        if not self.task:
+            await asyncio.to_thread(self.load)
+
+    async def start(self):
+        if not self.task:
+            await self.sync()
+            super().start()
+
+
+class LeaderElector(BackgroundTask):
+    def __init__(self, api_client, namespace: str, name: str, identity: str, duration: int = 15, deadline: int = 10,
+                 renew: int = 2, on_start=None, on_stop=None):
+        if not renew < deadline < duration:
+            raise ValueError('leader election requires renew < deadline < duration')
+        self.api = client.CoordinationV1Api(api_client)
+        self.namespace = namespace
+        self.name = name
+        self.identity = identity
+        self.duration = duration
+        self.deadline = deadline
+        self.renew = renew
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.leader = False
+        self.observed = None
+        self.observed_at = 0
+        self.renewed_at = 0
+        self.task = None
+
+    async def try_acquire(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            lease = await self.api.read_namespaced_lease(self.name, self.namespace, _request_timeout=3)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            try:
+                await self.api.create_namespaced_lease(self.namespace, client.V1Lease(
+                    metadata=client.V1ObjectMeta(name=self.name, namespace=self.namespace),
+                    spec=client.V1LeaseSpec(holder_identity=self.identity, lease_duration_seconds=self.duration,
+                                            acquire_time=now, renew_time=now, lease_transitions=0)),
+                    _request_timeout=3)
+            except ApiException as e:
+                if e.status == 409:
+                    return False
+                raise
+            return True
+        spec = lease.spec
+        if spec.holder_identity != self.identity:
+            # 以本地观察到的时间判断租约过期，避免依赖各节点时钟一致
+            record = (spec.holder_identity, spec.renew_time)
+            if record != self.observed:
+                self.observed = record
+                self.observed_at = time.monotonic()
+            if spec.holder_identity and \
+                    time.monotonic() < self.observed_at + (spec.lease_duration_seconds or self.duration):
+                return False
+            spec.holder_identity = self.identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.lease_duration_seconds = self.duration
+        spec.renew_time = now
+        try:
+            await self.api.replace_namespaced_lease(self.name, self.namespace, lease, _request_timeout=3)
+        except ApiException as e:
+            # resourceVersion 冲突说明被其他副本抢先
+            if e.status == 409:
+                return False
+            raise
+        return True
+
+    async def __switch__(self, leader: bool):
+        if leader == self.leader:
+            return
+        self.leader = leader
+        if leader:
+            logging.warning(f'{self.identity} 成为主节点')
+            if self.on_start:
+                await self.on_start()
+        else:
+            logging.warning(f'{self.identity} 不再是主节点')
+            if self.on_stop:
+                await self.on_stop()
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            # 主节点须在 deadline 内完成续约，早于其他副本判定租约过期 (duration)
+            timeout = self.renewed_at + self.deadline - start if self.leader else None
+            try:
+                acquired = await asyncio.wait_for(self.try_acquire(), timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                acquired = None
+            except Exception as e:
+                logging.warning(e)
+                acquired = None
+            if acquired:
+                self.renewed_at = start
+                await self.__switch__(True)
+            elif acquired is False or time.monotonic() >= self.renewed_at + self.deadline:
+                await self.__switch__(False)
+            if self.leader:
+                await asyncio.sleep(min(self.renew, max(0, self.renewed_at + self.deadline - time.monotonic())))
+            else:
+                await asyncio.sleep(self.renew)
+
+    async def release(self):
+        try:
+            lease = await self.api.read_namespaced_lease(self.name, self.namespace, _request_timeout=3)
+            if lease.spec.holder_identity == self.identity:
+                lease.spec.holder_identity = None
+                lease.spec.lease_duration_seconds = 1
+                await self.api.replace_namespaced_lease(self.name, self.namespace, lease, _request_timeout=3)
+        except ApiException as e:
+            logging.warning(e)
+
+    async def stop(self):
+        await super().stop()
+        if self.leader:
+            await self.__switch__(False)
+            await self.release()
+
+
 class Tunasync(object):
-    def __init__(self, api='http://127.0.0.1:14242'):
+    def __init__(self, api='http://127.0.0.1:14242', limit: int = 100, limit_per_host: int = 30,
+                 keepalive_timeout: int = 30, worker_ttl: int = 5):
         self.api = api
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.worker_ttl = worker_ttl
+        self.worker_cache = None
+        self.worker_expire = 0
+        self.worker_fetch = None
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, raise_for_status=True,
+                                                 timeout=aiohttp.ClientTimeout(total=3))
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     async def __requests__(self, uri, method: str = 'get', data: dict = None, ret: bool = True):
         url = self.api + uri
-        async with aiohttp.ClientSession(raise_for_status=True, timeout=3) as client:
-            async with client.request(method, url, json=data, timeout=3) as resp:
-                res = await resp.json()
-                if not ret:
-                    if resp.status == 200 and 'error' not in res:
-                        return True
-                    else:
-                        logging.warning(resp.text)
-                        return False
-                return res
+        with MANAGER_TIME.labels(method, MANAGER_URI.sub('/{}', uri)).time():
+            if self.session is None or self.session.closed:
+                async with aiohttp.ClientSession(raise_for_status=True,
+                                                 timeout=aiohttp.ClientTimeout(total=3)) as client:
+                    return await self.__response__(client, url, method, data, ret)
+            return await self.__response__(self.session, url, method, data, ret)
+
+    @staticmethod
+    async def __response__(client: aiohttp.ClientSession, url: str, method: str, data: dict, ret: bool):
+        async with client.request(method, url, json=data, timeout=aiohttp.ClientTimeout(total=3)) as resp:
+            res = await resp.json()
+            if not ret:
+                if resp.status == 200 and 'error' not in res:
+                    return True
+                else:
+                    logging.warning(resp.text)
+                    return False
+            return res
 
     async def jobs(self, worker: str = '') -> list:
         if worker:
@@ -567,6 +1660,31 @@ class Tunasync(object):
         else:
             return []
 
+    async def worker_index(self) -> dict:
+        if self.worker_cache is not None and time.monotonic() < self.worker_expire:
+            return self.worker_cache
+        if self.worker_fetch is None:
+            self.worker_fetch = asyncio.ensure_future(self.__fetch_workers__())
+        fetch = self.worker_fetch
+        try:
+            return await asyncio.shield(fetch)
+        finally:
+            if self.worker_fetch is fetch and fetch.done():
+                self.worker_fetch = None
+
+    async def __fetch_workers__(self) -> dict:
+        workers = {i['id']: i for i in await self.workers()}
+        # 获取期间被 invalidate 的结果不写入缓存
+        if self.worker_fetch is asyncio.current_task():
+            self.worker_cache = workers
+            self.worker_expire = time.monotonic() + self.worker_ttl
+        return workers
+
+    def invalidate_workers(self):
+        self.worker_cache = None
+        self.worker_expire = 0
+        self.worker_fetch = None
+
     async def flush_disabled(self) -> bool:
         try:
             return await self.__requests__('/jobs/disabled', method='delete', ret=False)
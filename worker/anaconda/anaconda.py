@@ -4,15 +4,22 @@ import json
 import logging
 import os
 import random
+import re
 import shutil
 import subprocess as sp
 import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parsedate_to_datetime
 from pathlib import Path
 
 from pyquery import PyQuery as pq
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 DEFAULT_CONDA_REPO_BASE = "https://repo.continuum.io"
@@ -23,6 +30,11 @@ CONDA_CLOUD_BASE_URL = os.getenv("CONDA_COULD_URL", "https://conda.anaconda.org"
 
 WORKING_DIR = os.getenv("TUNASYNC_WORKING_DIR")
 
+# number of concurrent package downloads, shared by all subdirs
+DOWNLOAD_WORKERS = int(os.getenv("CONDA_DOWNLOAD_WORKERS", "8"))
+# number of subdirs synced at the same time
+SYNC_JOBS = int(os.getenv("CONDA_SYNC_JOBS", "4"))
+
 CONDA_REPOS = ("main", "free", "r", "msys2")
 CONDA_ARCHES = (
     "noarch", "linux-64", "linux-32", "linux-aarch64", "linux-armv6l", "linux-armv7l",
@@ -108,7 +120,256 @@ def curl_download(remote_url: str, dst_file: Path, md5: str = None):
         return "MD5 mismatch"
 
 
-def sync_repo(repo_url: str, local_dir: Path, tmpdir: Path, delete: bool):
+_local = threading.local()
+
+def get_session():
+    # one keep-alive session per download thread
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(
+            total=10, backoff_factor=0.5, status_forcelist=(408, 429, 500, 502, 503, 504)))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def save_response(r, dst_file: Path):
+    m = hashlib.md5()
+    with dst_file.open('wb') as f:
+        for buf in r.iter_content(1*1024*1024):
+            f.write(buf)
+            m.update(buf)
+    if 'last-modified' in r.headers:
+        remote_date = parsedate_to_datetime(r.headers['last-modified']).timestamp()
+        os.utime(dst_file, (remote_date, remote_date))
+    return m.hexdigest()
+
+
+def http_download(remote_url: str, dst_file: Path, md5: str = None):
+    with get_session().get(remote_url, stream=True, timeout=TIMEOUT_OPTION) as r:
+        r.raise_for_status()
+        digest = save_response(r, dst_file)
+    if md5 and digest != md5:
+        return "MD5 mismatch"
+
+
+def conditional_download(remote_url: str, dst_file: Path, state: dict):
+    """Fetch remote_url unless it matches the validators in state, return the new validators or None."""
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    with get_session().get(remote_url, headers=headers, stream=True, timeout=TIMEOUT_OPTION) as r:
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        return {
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified'),
+            'md5': save_response(r, dst_file),
+        }
+
+
+def load_state(state_file: Path):
+    try:
+        with state_file.open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_file: Path, state: dict):
+    tmp_file = state_file.with_name(state_file.name + '.tmp')
+    with tmp_file.open('w') as f:
+        json.dump(state, f)
+    tmp_file.rename(state_file)
+
+
+def download_package(pkg_url: str, dst_file: Path, md5: str = None):
+    filename = dst_file.name
+    dst_file_wip = dst_file.with_name('.downloading.' + filename)
+    for retry in range(3):
+        logging.info("Downloading {}".format(filename))
+        try:
+            err = http_download(pkg_url, dst_file_wip, md5=md5)
+            if err is None:
+                dst_file_wip.rename(dst_file)
+        except (requests.RequestException, OSError) as e:
+            err = repr(e)
+        if err is None:
+            return True
+        logging.error("Failed to download {}: {}".format(filename, err))
+    return False
+
+
+class DownloadPool:
+    """Download threads shared by all channels, taking tasks from each channel in turn."""
+
+    def __init__(self, workers: int):
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def map(self, key: str, func, items, callback, limit: int = None):
+        """Run func(*args) for each args taken lazily from items, at most limit of them pending at once.
+
+        callback(args, result) runs in the download threads, one call at a time. Blocks until every
+        task has finished, then re-raises the first exception of func or callback.
+        """
+        limit = limit or 2 * len(self.threads)
+        slots = threading.Semaphore(limit)
+        lock = threading.Lock()
+        errors = []
+
+        def done(args, result, error):
+            try:
+                with lock:
+                    if error is None:
+                        callback(args, result)
+                    else:
+                        errors.append(error)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+        try:
+            for args in items:
+                slots.acquire()
+                if errors:
+                    slots.release()
+                    break
+                with self.cond:
+                    self.queues.setdefault(key, deque()).append((func, args, done))
+                    self.cond.notify()
+        finally:
+            # wait for the tasks already handed to the pool
+            for _ in range(limit):
+                slots.acquire()
+        if errors:
+            raise errors[0]
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.queues and not self.closed:
+                    self.cond.wait()
+                if not self.queues:
+                    return
+                # round-robin: the channel just served goes to the back
+                key, queue = self.queues.popitem(last=False)
+                func, args, done = queue.popleft()
+                if queue:
+                    self.queues[key] = queue
+            try:
+                result = func(*args)
+            except BaseException as e:
+                done(args, None, e)
+            else:
+                done(args, result, None)
+
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
+
+class JSONStream:
+    """Decode a JSON document value by value from a file, keeping only a small window in memory."""
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size: int = 1*1024*1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def expect(self, chars: str):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expecting one of {!r} at {!r}".format(chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                # a value ending exactly at the window edge may be a truncated number
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        """Yield (key, stream) of an object, the caller must consume each value."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key, self
+            if self.expect(',}') == '}':
+                return
+
+
+def iter_packages(repodata_file: Path):
+    """Yield (filename, name, size, md5) of every package in a repodata.json."""
+    with repodata_file.open(encoding='utf-8') as f:
+        stream = JSONStream(f)
+        for key, _ in stream.items():
+            if key not in ('packages', 'packages.conda'):
+                stream.value()
+                continue
+            for filename, _ in stream.items():
+                meta = stream.value()
+                yield filename, meta['name'], meta['size'], meta['md5']
+
+
+def repodata_index(repodata_file: Path):
+    """Compact filename -> (size, md5) index of a repodata.json."""
+    index = {}
+    for filename, name, size, md5 in iter_packages(repodata_file):
+        if name not in EXCLUDED_PACKAGES:
+            index[filename] = (size, bytes.fromhex(md5))
+    return index
+
+
+def sync_repo(repo_url: str, local_dir: Path, tmpdir: Path, delete: bool, pool: DownloadPool, channel: str = None):
     logging.info("Start syncing {}".format(repo_url))
     local_dir.mkdir(parents=True, exist_ok=True)
 
@@ -122,56 +383,86 @@ def sync_repo(repo_url: str, local_dir: Path, tmpdir: Path, delete: bool):
     tmp_bz2_repodata = tmpdir / "repodata.json.bz2"
     tmp_current_repodata = tmpdir / 'current_repodata.json'
 
-    curl_download(repodata_url, tmp_repodata)
-    curl_download(bz2_repodata_url, tmp_bz2_repodata)
+    # validators and stats of the last complete sync of this subdir
+    state_file = local_dir / '.sync-state.json'
+    state = load_state(state_file) if (local_dir / 'repodata.json').is_file() else {}
+    validators = conditional_download(repodata_url, tmp_repodata, state)
+    if validators is None or validators['md5'] == state.get('md5'):
+        if validators is not None:
+            state.update(validators)
+            save_state(state_file, state)
+        logging.info("{} unchanged, skipping".format(repodata_url))
+        return {'files': state.get('files', 0), 'size': state.get('size', 0),
+                'downloaded': 0, 'bytes': 0, 'failed': 0}
+
+    http_download(bz2_repodata_url, tmp_bz2_repodata)
     try:
-        curl_download(current_repodata_url, tmp_current_repodata)
-    except:
-        pass
+        http_download(current_repodata_url, tmp_current_repodata)
+    except requests.RequestException:
+        tmp_current_repodata.unlink(missing_ok=True)
 
-    with tmp_repodata.open() as f:
-        repodata = json.load(f)
+    # the local repodata.json is a complete snapshot when the state file exists
+    previous = {}
+    if state:
+        try:
+            previous = repodata_index(local_dir / 'repodata.json')
+        except (OSError, ValueError, KeyError):
+            logging.exception("Failed to load previous repodata of {}".format(repo_url))
+    full_scan = not previous or random.random() < 0.1 # Do full stat sweep less frequently
 
-    remote_filelist = []
+    remote_filelist = set()
     total_size = 0
-    packages = repodata['packages']
-    if 'packages.conda' in repodata:
-        packages.update(repodata['packages.conda'])
-    for filename, meta in packages.items():
-        if meta['name'] in EXCLUDED_PACKAGES:
-            continue
+    stats = {'downloaded': 0, 'bytes': 0, 'failed': 0}
 
-        file_size, md5 = meta['size'], meta['md5']
-        total_size += file_size
-
-        pkg_url = '/'.join([repo_url, filename])
-        dst_file = local_dir / filename
-        dst_file_wip = local_dir / ('.downloading.' + filename)
-        remote_filelist.append(dst_file)
+    # fed to the pool while repodata.json is being read, so pending downloads are never all in memory
+    def pending():
+        nonlocal total_size
+        for filename, name, file_size, md5 in iter_packages(tmp_repodata):
+            if name in EXCLUDED_PACKAGES:
+                continue
 
-        if dst_file.is_file():
-            stat = dst_file.stat()
-            local_filesize = stat.st_size
+            total_size += file_size
+            remote_filelist.add(filename)
 
-            if file_size == local_filesize:
-                logging.info("Skipping {}".format(filename))
+            # unchanged since the last complete sync, no need to stat it
+            old = previous.get(filename)
+            if not full_scan and old == (file_size, bytes.fromhex(md5)):
                 continue
 
-            dst_file.unlink()
+            pkg_url = '/'.join([repo_url, filename])
+            dst_file = local_dir / filename
 
-        for retry in range(3):
-            logging.info("Downloading {}".format(filename))
-            try:
-                err = curl_download(pkg_url, dst_file_wip, md5=md5)
-                if err is None:
-                    dst_file_wip.rename(dst_file)
-            except sp.CalledProcessError:
-                err = 'CalledProcessError'
-            if err is None:
-                break
-            logging.error("Failed to download {}: {}".format(filename, err))
+            if dst_file.is_file():
+                stat = dst_file.stat()
+                local_filesize = stat.st_size
+
+                if file_size == local_filesize and (old is None or old[1] == bytes.fromhex(md5)):
+                    logging.info("Skipping {}".format(filename))
+                    continue
+
+                dst_file.unlink()
+
+            yield pkg_url, dst_file, md5, file_size
+
+    def fetch(pkg_url: str, dst_file: Path, md5: str, file_size: int):
+        return download_package(pkg_url, dst_file, md5)
 
+    def done(args, ok: bool):
+        if ok:
+            stats['downloaded'] += 1
+            stats['bytes'] += args[3]
+        else:
+            stats['failed'] += 1
 
+    pool.map(channel or repo_url, fetch, pending(), done)
+    if not full_scan:
+        logging.info("{}: {} changed since last sync".format(repo_url, stats['downloaded'] + stats['failed']))
+    failed = stats['failed']
+    if failed:
+        logging.error("{} files failed to download".format(failed))
+
+    # the state file must never describe a repodata.json it was not written for
+    state_file.unlink(missing_ok=True)
     shutil.move(str(tmp_repodata), str(local_dir / "repodata.json"))
     shutil.move(str(tmp_bz2_repodata), str(local_dir / "repodata.json.bz2"))
     if tmp_current_repodata.is_file():
@@ -181,19 +472,46 @@ def sync_repo(repo_url: str, local_dir: Path, tmpdir: Path, delete: bool):
     if delete:
         local_filelist = []
         delete_count = 0
-        for i in local_dir.glob('*.tar.bz2'):
-            local_filelist.append(i)
-        for i in local_dir.glob('*.conda'):
-            local_filelist.append(i)
-        for i in set(local_filelist) - set(remote_filelist):
+        if full_scan:
+            for i in local_dir.glob('*.tar.bz2'):
+                local_filelist.append(i)
+            for i in local_dir.glob('*.conda'):
+                local_filelist.append(i)
+        else:
+            # only files dropped from the index since the last sync
+            local_filelist = [local_dir / i for i in previous]
+        for i in local_filelist:
+            if i.name in remote_filelist:
+                continue
             logging.info("Deleting {}".format(i))
-            i.unlink()
+            i.unlink(missing_ok=True)
             delete_count += 1
         logging.info("{} files deleted".format(delete_count))
 
+    if not failed:
+        validators.update(files=len(remote_filelist), size=total_size)
+        save_state(state_file, validators)
+
     logging.info("{}: {} files, {} in total".format(
         repodata_url, len(remote_filelist), sizeof_fmt(total_size)))
-    return total_size
+    return {
+        'files': len(remote_filelist),
+        'size': total_size,
+        **stats,
+    }
+
+
+def sync_subdir(channel: str, remote_url: str, local_dir: Path, delete: bool, pool: DownloadPool):
+    tmpdir = tempfile.mkdtemp()
+    start = time.monotonic()
+    stats = None
+    try:
+        stats = sync_repo(remote_url, local_dir, Path(tmpdir), delete, pool, channel)
+    except Exception:
+        logging.exception("Failed to sync repo: {}".format(remote_url))
+    finally:
+        shutil.rmtree(tmpdir)
+    return channel, stats, start, time.monotonic()
 
 def sync_installer(repo_url, local_dir: Path):
     logging.info("Start syncing {}".format(repo_url))
@@ -260,6 +578,10 @@ def main():
     parser.add_argument("--working-dir", default=WORKING_DIR)
     parser.add_argument("--delete", action='store_true',
                         help='delete unreferenced package files')
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                        help='number of concurrent package downloads in total')
+    parser.add_argument("--jobs", type=int, default=SYNC_JOBS,
+                        help='number of subdirs synced concurrently')
     args = parser.parse_args()
 
     if args.working_dir is None:
@@ -280,32 +602,38 @@ def main():
         except Exception:
             logging.exception("Failed to sync installers of {}".format(dist))
 
+    subdirs = []
     for repo in CONDA_REPOS:
         for arch in CONDA_ARCHES:
             remote_url = "{}/pkgs/{}/{}".format(CONDA_REPO_BASE_URL, repo, arch)
             local_dir = working_dir / "pkgs" / repo / arch
-
-            tmpdir = tempfile.mkdtemp()
-            try:
-                size_statistics += sync_repo(remote_url,
-                                             local_dir, Path(tmpdir), args.delete)
-            except Exception:
-                logging.exception("Failed to sync repo: {}/{}".format(repo, arch))
-            finally:
-                shutil.rmtree(tmpdir)
+            subdirs.append(("pkgs/" + repo, remote_url, local_dir))
 
     for repo in CONDA_CLOUD_REPOS:
         remote_url = "{}/{}".format(CONDA_CLOUD_BASE_URL, repo)
         local_dir = working_dir / "cloud" / repo
-
-        tmpdir = tempfile.mkdtemp()
-        try:
-            size_statistics += sync_repo(remote_url,
-                                         local_dir, Path(tmpdir), args.delete)
-        except Exception:
-            logging.exception("Failed to sync repo: {}".format(repo))
-        finally:
-            shutil.rmtree(tmpdir)
+        subdirs.append((repo.rsplit('/', 1)[0], remote_url, local_dir))
+
+    pool = DownloadPool(args.workers)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda i: sync_subdir(*i, args.delete, pool), subdirs))
+    pool.shutdown()
+
+    summary = OrderedDict()
+    for channel, stats, start, end in results:
+        item = summary.setdefault(channel, {'files': 0, 'size': 0, 'downloaded': 0, 'bytes': 0, 'failed': 0,
+                                            'errors': 0, 'start': start, 'end': end})
+        item['start'], item['end'] = min(item['start'], start), max(item['end'], end)
+        if stats is None:
+            item['errors'] += 1
+            continue
+        for k in ('files', 'size', 'downloaded', 'bytes', 'failed'):
+            item[k] += stats[k]
+    for channel, item in summary.items():
+        logging.info("{}: {} files, {} in total, {} downloaded ({}), {} failed, {} subdirs errored, {:.0f}s".format(
+            channel, item['files'], sizeof_fmt(item['size']), item['downloaded'], sizeof_fmt(item['bytes']),
+            item['failed'], item['errors'], item['end'] - item['start']))
+        size_statistics += item['size']
 
     print("Total size is", sizeof_fmt(size_statistics, suffix=""))
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Equivalence check and benchmark of the streaming repodata parser in anaconda.py.
+
+Checks JSONStream/iter_packages against json.load on hand-written edge cases with tiny
+read windows and on a large synthetic repodata.json, then compares peak memory and parse
+time of json.load + dict.update with iter_packages, each in a fresh process.
+
+    python3 bench_repodata.py [--packages 300000]
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import anaconda  # noqa: E402
+
+
+def generate(path: Path, count: int):
+    random.seed(1)
+
+    def entry(i):
+        return {
+            "build": "py310h{:07x}_0".format(i), "build_number": i % 7,
+            "depends": ["python >=3.10,<3.11.0a0", "libgcc-ng >=12", "dep{} >=1.{}".format(i % 97, i % 13)],
+            "license": "BSD-3-Clause", "md5": hashlib.md5(str(i).encode()).hexdigest(),
+            "name": "pkg{}".format(i % 20000), "sha256": hashlib.sha256(str(i).encode()).hexdigest(),
+            "size": random.randint(1000, 10**8), "subdir": "linux-64", "timestamp": 1600000000000 + i,
+            "version": "1.{}.{}".format(i % 50, i % 7), "constrains": ["foo >=1"] if i % 3 else [],
+        }
+
+    half = count // 2
+    with path.open('w') as f:
+        json.dump({
+            "info": {"subdir": "linux-64"},
+            "packages": {"pkg{}-1.0-py_{}.tar.bz2".format(i, i): entry(i) for i in range(half)},
+            "packages.conda": {"pkg{}-1.0-py_{}.conda".format(i, i): entry(i) for i in range(half, count)},
+            "removed": ["x{}.tar.bz2".format(i) for i in range(1000)],
+            "repodata_version": 1,
+        }, f, indent=1)
+
+
+def reference(repodata: dict):
+    return [(filename, meta['name'], meta['size'], meta['md5'])
+            for key in ('packages', 'packages.conda') for filename, meta in repodata.get(key, {}).items()]
+
+
+def check(path: Path):
+    docs = [
+        {},
+        {"packages": {}, "packages.conda": {"a.conda": {"name": "a", "size": 12345, "md5": "00" * 16}}},
+        {"info": {"x": [1, 2.5e3, None, True, "é\\\"}"]}, "repodata_version": 123456789,
+         "packages": {"b\"{}.tar.bz2": {"name": "b", "size": 1, "md5": "ff" * 16}}},
+    ]
+    for doc in docs:
+        for indent in (None, 2):
+            text = json.dumps(doc, indent=indent)
+            for chunk_size in (1, 2, 3, 7, 1000):
+                stream = anaconda.JSONStream(io.StringIO(text), chunk_size)
+                got = []
+                for key, _ in stream.items():
+                    if key not in ('packages', 'packages.conda'):
+                        stream.value()
+                        continue
+                    for filename, _ in stream.items():
+                        meta = stream.value()
+                        got.append((filename, meta['name'], meta['size'], meta['md5']))
+                assert got == reference(doc), (doc, chunk_size, got)
+    with path.open() as f:
+        expect = reference(json.load(f))
+    assert list(anaconda.iter_packages(path)) == expect
+    print("iter_packages matches json.load ({} entries and edge cases)".format(len(expect)))
+
+
+def memory(field: str) -> int:
+    # VmHWM is per address space, ru_maxrss would carry the parent's peak across exec
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field + ':'))
+
+
+def measure(mode: str, path: Path):
+    base = memory('VmRSS')
+    start = time.perf_counter()
+    count = 0
+    if mode == 'json':
+        with path.open() as f:
+            repodata = json.load(f)
+        packages = repodata['packages']
+        packages.update(repodata.get('packages.conda', {}))
+        for filename, meta in packages.items():
+            count += 1
+    else:
+        for _ in anaconda.iter_packages(path):
+            count += 1
+    elapsed = time.perf_counter() - start
+    peak = (memory('VmHWM') - base) / 1024
+    print("{:>14}: {} entries, {:.2f}s, peak RSS +{:.0f} MiB".format(
+        'json.load' if mode == 'json' else 'iter_packages', count, elapsed, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packages", type=int, default=300000)
+    parser.add_argument("--measure", choices=('json', 'stream'), help=argparse.SUPPRESS)
+    parser.add_argument("--file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, Path(args.file))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'repodata.json'
+        generate(path, args.packages)
+        print("repodata.json: {:.0f} MB, {} packages".format(path.stat().st_size / 1e6, args.packages))
+        check(path)
+        # each parser runs in its own process so peak RSS is not shared
+        for mode in ('json', 'stream'):
+            subprocess.run([sys.executable, __file__, "--measure", mode, "--file", str(path)], check=True)
+
+
+if __name__ == "__main__":
+    main()